@@ -0,0 +1,113 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+"""
+Batch Planning
+plans every listed well pad concurrently on a process pool: probability distribution, waypoint extraction and path
+generation, without ever opening a plot window
+outputs (in OutputDir):   waypoints_pad{N}.txt -   waypoints of pad N, in the same format as waypoints2.txt
+                          path_pad{N}.txt      -   x,y coordinates of the flight path of pad N
+                          path_pad{N}.png      -   plot of the flight path of pad N (only with --plot)
+                          timing_summary.txt   -   time spent in each step for every pad, with the number of
+                                                  segment vs obstacle tests done and culled by the spatial index
+usage: python BatchPlanning.py 1 2 3 4 --workers 4
+"""
+
+def _HeadlessWorker():
+	#selects a non-interactive matplotlib backend before any planning module imports pyplot (DistributionSetUp does at
+	#load), so no plot window is ever opened by a worker
+	os.environ['MPLBACKEND'] = 'Agg'
+
+def PlanPad(WellPadNumber, OutputDir, power=10, WindSpeed=2, WindDirection=0, CacheDir=None, Plot=False):
+	#runs the whole before-flight pipeline of main.py for one well pad and returns the time spent in each step
+	from DistributionSetUp import FindP_WellPad
+	from initialwaypoint import initwaypoint
+	from PathGeneration import PlanPath, RenderPath
+	import flightdata
+
+	Timing = {'pad': WellPadNumber}
+	start = time.perf_counter()
+
+	Cache = None
+	if CacheDir is not None:
+		from DistributionCache import DistributionCache
+		Cache = DistributionCache(CacheDir)
+
+	P, Spacing, Shift = FindP_WellPad(Plot_P=False, WellPadNumber=WellPadNumber, WindSpeed=WindSpeed, WindDirection=WindDirection, Cache=Cache)
+	Timing['distribution'] = time.perf_counter() - start
+
+	step = time.perf_counter()
+	WayPoints = initwaypoint(P, Spacing[0], Spacing[1], Spacing[2], power=power)
+	#shift coordinates back
+	WayPoints[:,0] += Shift[0]
+	WayPoints[:,1] += Shift[1]
+	WayPointFile = os.path.join(OutputDir, 'waypoints_pad{}.txt'.format(WellPadNumber))
+	np.savetxt(WayPointFile, WayPoints)
+	Timing['waypoints'] = time.perf_counter() - step
+	Timing['n_waypoints'] = len(WayPoints)
+
+	step = time.perf_counter()
+	FD = flightdata.FlightData()
+	FD.import_wellpad_components("./METEC Site Data/equipment_tags/Pad {}.kml".format(WellPadNumber))
+	Path, Tour, EdgeCosts, Stats = PlanPath(WayPoints, FD.wellpad_components, WindDirection)
+	np.savetxt(os.path.join(OutputDir, 'path_pad{}.txt'.format(WellPadNumber)), np.transpose(Path))
+	Timing['path'] = time.perf_counter() - step
+	#segment vs obstacle tests done, and skipped by the spatial index
+	Timing['tests'] = Stats['tests']
+	Timing['culled'] = Stats['culled']
+
+	if Plot:
+		RenderPath(Path, WayPoints, FD.wellpad_components, os.path.join(OutputDir, 'path_pad{}.png'.format(WellPadNumber)))
+
+	Timing['total'] = time.perf_counter() - start
+	return Timing
+
+def PlanPads(WellPadNumbers, OutputDir='.', workers=None, **options):
+	#plans all pads on a process pool; a pad that fails is reported in the summary instead of stopping the others
+	os.makedirs(OutputDir, exist_ok=True)
+	start = time.perf_counter()
+	with ProcessPoolExecutor(max_workers=workers, initializer=_HeadlessWorker) as pool:
+		tasks = [(pad, pool.submit(PlanPad, pad, OutputDir, **options)) for pad in WellPadNumbers]
+		Timings = []
+		for pad, task in tasks:
+			try:
+				Timings.append(task.result())
+			except Exception as e:
+				Timings.append({'pad': pad, 'error': '{}: {}'.format(type(e).__name__, e)})
+	WallTime = time.perf_counter() - start
+
+	WriteTimingSummary(os.path.join(OutputDir, 'timing_summary.txt'), Timings, WallTime)
+	return Timings
+
+def WriteTimingSummary(filename, Timings, WallTime):
+	columns = ['distribution', 'waypoints', 'path', 'total']
+	lines = ['pad\tn_waypoints\ttests\tculled\t' + '\t'.join(c + '(s)' for c in columns)]
+	for Timing in Timings:
+		if 'error' in Timing:
+			lines.append('{}\tfailed: {}'.format(Timing['pad'], Timing['error']))
+		else:
+			lines.append('{}\t{}\t{}\t{}\t'.format(Timing['pad'], Timing['n_waypoints'], Timing['tests'], Timing['culled']) +
+			             '\t'.join('{:.3f}'.format(Timing[c]) for c in columns))
+	lines.append('wall time (s)\t{:.3f}'.format(WallTime))
+
+	with open(filename, 'w') as f:
+		f.write('\n'.join(lines) + '\n')
+	print('\n'.join(lines))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Plan flight paths for several well pads at once.')
+	parser.add_argument('pads', type=int, nargs='+', help='well pad numbers, as in "METEC Site Data/equipment_tags/Pad N.kml"')
+	parser.add_argument('--output', default='.', help='folder for the waypoint, path and timing files')
+	parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+	parser.add_argument('--power', type=int, default=10, help='window radius of the waypoint local maximum search')
+	parser.add_argument('--wind-speed', type=float, default=2)
+	parser.add_argument('--wind-direction', type=float, default=0)
+	parser.add_argument('--cache', default=None, help='folder of a DistributionCache to reuse distributions between runs')
+	parser.add_argument('--plot', action='store_true', help='also write a plot of each path')
+	args = parser.parse_args()
+
+	PlanPads(args.pads, args.output, workers=args.workers, power=args.power, WindSpeed=args.wind_speed,
+	         WindDirection=args.wind_direction, CacheDir=args.cache, Plot=args.plot)
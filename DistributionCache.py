@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from ProbDist import LoadDistribution, _MetadataFile
+
+class DistributionCache:
+	#on-disk cache of FindP_WellPad results, addressed by a hash of everything the distribution depends on
+	#each entry is a memory-mapped .npy file with its .json metadata, as written by ProbDist(..., P_file=...)
+	def __init__(self,
+		         directory, #folder holding the cached distributions
+		         max_bytes = None, #total size above which the least recently used entries are evicted
+		         max_age = None, #entries not used for this many seconds are evicted
+		         wind_speed_step = 0, #wind speeds are rounded to a multiple of this (m/s) before lookup; 0 keeps them exact
+		         wind_dir_step = 0 #wind directions are rounded to a multiple of this (degrees) before lookup
+		         ):
+
+		self.directory = directory;
+		self.max_bytes = max_bytes;
+		self.max_age = max_age;
+		self.wind_speed_step = wind_speed_step;
+		self.wind_dir_step = wind_dir_step;
+		os.makedirs(directory, exist_ok=True);
+
+	def Quantize(self, WindSpeed, WindDirection):
+		#close wind conditions map to the same entry; the distribution is then computed for the rounded values
+		WindSpeed = float(WindSpeed);
+		WindDirection = float(WindDirection) % 360.;
+		if self.wind_speed_step:
+			WindSpeed = max(self.wind_speed_step, round(WindSpeed/self.wind_speed_step)*self.wind_speed_step);
+		if self.wind_dir_step:
+			WindDirection = (round(WindDirection/self.wind_dir_step)*self.wind_dir_step) % 360.;
+
+		return WindSpeed, WindDirection
+
+	def Key(self, KmlFile, **Parameters):
+		#sha256 of the kml contents and of the parameters (grid_size, wind, padding, ...) the distribution is built with
+		#array parameters (e.g. wind samples) are hashed by value
+		h = hashlib.sha256();
+		h.update(self.FileHash(KmlFile).encode());
+		for name in sorted(Parameters):
+			value = Parameters[name];
+			h.update(name.encode());
+			if isinstance(value, np.ndarray):
+				h.update(str(value.dtype).encode());
+				h.update(np.ascontiguousarray(value).tobytes());
+			else:
+				h.update(json.dumps(value, sort_keys=True, default=_JsonDefault).encode());
+
+		return h.hexdigest()
+
+	@staticmethod
+	def FileHash(filename):
+		#sha256 of the contents of a file, e.g. a flight data .csv the distribution also depends on
+		h = hashlib.sha256();
+		with open(filename, 'rb') as f:
+			for block in iter(lambda: f.read(2**20), b''):
+				h.update(block);
+		return h.hexdigest()
+
+	def Path(self, Key):
+		return os.path.join(self.directory, Key + '.npy')
+
+	def Get(self, Key):
+		#(P, Spacing, Shift) of a cached distribution, with P memory-mapped, or None on a miss
+		#entries are evicted first, so a cache that is only read still honours max_age; the requested entry is only
+		#evicted if it has expired
+		self.Evict(keep=Key);
+		Path = self.Path(Key);
+		if not (os.path.exists(Path) and os.path.exists(_MetadataFile(Path))):
+			return None
+		#the access time is kept in the modification time so that eviction removes the least recently used entries
+		now = time.time();
+		os.utime(Path, (now, now));
+
+		return LoadDistribution(Path)
+
+	def TempPath(self, Key):
+		#entries are written under a temporary name and moved into place by Commit, so a concurrent reader never
+		#sees a partially written distribution
+		return os.path.join(self.directory, '{}.{}.tmp.npy'.format(Key, os.getpid()))
+
+	def Commit(self, Key, TempPath):
+		Path = self.Path(Key);
+		os.replace(TempPath, Path);
+		#the metadata is moved last; Get only reports entries that have it
+		os.replace(_MetadataFile(TempPath), _MetadataFile(Path));
+		#the new entry is kept even if it alone is larger than max_bytes
+		self.Evict(keep=Key);
+
+	def Evict(self, keep = None):
+		#removes entries older than max_age, then the least recently used ones until the cache fits in max_bytes
+		#the entry of key keep, if given, is only removed if it is older than max_age, never to fit in max_bytes
+		Kept = None if keep is None else self.Path(keep);
+		entries = [];
+		for name in os.listdir(self.directory):
+			if not name.endswith('.npy') or name.endswith('.tmp.npy'):
+				continue
+			Path = os.path.join(self.directory, name);
+			try:
+				stat = os.stat(Path);
+			except OSError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, Path));
+		entries.sort();
+
+		now = time.time();
+		total = sum(entry[1] for entry in entries);
+		for mtime, nbytes, Path in entries:
+			expired = self.max_age is not None and now - mtime > self.max_age;
+			too_big = self.max_bytes is not None and total > self.max_bytes and Path != Kept;
+			if not (expired or too_big):
+				continue
+			for f in (Path, _MetadataFile(Path)):
+				try:
+					os.remove(f);
+				except OSError:
+					pass
+			total -= nbytes;
+
+def _JsonDefault(value):
+	#numpy scalars and arrays in the key parameters
+	if isinstance(value, np.generic):
+		return value.item()
+	return np.asarray(value).tolist()
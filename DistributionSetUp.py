@@ -3,69 +3,67 @@ from ProbDist import ProbDist
 import numpy as np
 import matplotlib.pyplot as plt
 
-def FindP_WellPad(Plot_P = True, WellPadNumber = 1, WindSpeed = 2, WindDirection = 0):
+def FindP_WellPad(Plot_P = True, WellPadNumber = 1, WindSpeed = 2, WindDirection = 0, WindSamples = None, P_dtype = np.float64, P_file = None,
+	              grid_size = (200,200,20), Padding = (40,20,6), Cache = None, InflightFile = None):
 	#Plot_P is a boolean that determines whether or not the probability distribution is plotted
+	#WindSamples is an optional (wind speeds, wind directions) pair, e.g. the wind_speeds and wind_directions columns of
+	#FD.inflight_data; if given, P is the expected distribution over those samples instead of a single wind
+	#P_dtype sets the storage type of P, and P_file backs it with a memory-mapped .npy file that ProbDist.LoadDistribution
+	#can reopen later without recomputing it
+	#Padding is the margin in meters added (before the lowest, after the highest) component in x and y, and above the highest in z
+	#InflightFile is an optional flight data .csv (e.g. "./METEC Site Data/sample_uas_dataset.csv"); the grid is then sized
+	#to also cover the flight
+	#Cache is an optional DistributionCache.DistributionCache; a distribution already computed for the same kml file, grid,
+	#padding and (quantized) wind is then returned from disk instead of being recomputed. The cache stores P in its own
+	#directory, so it can not be combined with P_file
+	if Cache is not None and P_file is not None:
+		raise ValueError('P_file can not be combined with Cache; cached distributions are stored in the cache directory.')
+	KmlFile = "./METEC Site Data/equipment_tags/Pad {}.kml".format(WellPadNumber);
+
+	Key = None;
+	def CacheLookup():
+		#quantizes the wind, then looks the distribution up; P is computed for the quantized wind on a miss
+		Speed, Direction = Cache.Quantize(WindSpeed, WindDirection);
+		Samples = None if WindSamples is None else np.asarray(WindSamples, dtype=float);
+		Inflight = None if InflightFile is None else Cache.FileHash(InflightFile);
+		Key = Cache.Key(KmlFile, grid_size=list(grid_size), Padding=list(Padding), WindSpeed=Speed, WindDirection=Direction,
+		                WindSamples=Samples, P_dtype=np.dtype(P_dtype).str, Inflight=Inflight);
+		return Key, Speed, Direction, Cache.Get(Key)
+
+	#the wind for well pad 1 comes from the flight data, so its lookup has to wait until the kml file is read
+	Hit = None;
+	if Cache is not None and WellPadNumber != 1:
+		Key, WindSpeed, WindDirection, Hit = CacheLookup();
+		if Hit is not None and not Plot_P:
+			return Hit
+
 	FD = flightdata.FlightData();
-	FD.import_wellpad_components("./METEC Site Data/equipment_tags/Pad {}.kml".format(WellPadNumber))
-	#FD.import_inflight_measurements("./METEC Site Data/sample_uas_dataset.csv") #use this to find the size of the well pad
+	FD.import_wellpad_components(KmlFile)
+	if InflightFile is not None:
+		FD.import_inflight_measurements(InflightFile)
 
 	#determine the range of the coordinates so that we can shift them to make all coordinates (i*delta_x, j*delta_y, k*delta_z)
-	min_x =0; min_y=0; min_z = 0; 
-	max_x=0; max_y=0; max_z=0;
-
-	for item in FD.wellpad_components:
-		if item.pos[0]<min_x:
-			min_x = item.pos[0]
-		elif item.pos[0]>max_x:
-			max_x = item.pos[0]
-
-		if item.pos[1]<min_y:
-			min_y = item.pos[1]
-		elif item.pos[1]>max_y:
-			max_y = item.pos[1]
-
-		if item.pos[2]>max_z:
-			max_z = item.pos[2]
-
-	"""
-	for item in FD.inflight_data['x']:
-		if item<min_x:
-			min_x = item;
-		elif item>max_x:
-			max_x = item;
-
-	for item in FD.inflight_data['y']:
-		if item<min_y:
-			min_y = item;
-		elif item>max_y:
-			max_y = item;
-
-	for item in FD.inflight_data['z']:
-		if item<min_z:
-			min_z = item;
-		elif item>max_z:
-			max_z = item;
-	"""
+	#the origin is kept inside the range, and the flight data (if any) is folded in so the grid covers the whole flight
+	Points = [np.zeros((1,3)), FD.component_positions];
+	if InflightFile is not None:
+		Points.append(FD.inflight_data[['x','y','z']].to_numpy(dtype=float));
+	Points = np.vstack(Points);
+	min_x, min_y, min_z = np.nanmin(Points, axis=0);
+	max_x, max_y, max_z = np.nanmax(Points, axis=0);
 
 	#shift all coordinates
-	Shift = [min_x-40, min_y-40,0];
-	for i in range(0,len(FD.wellpad_components)):
-		#add 3m to the z component of the component location since we don't have the real height of the components
-		FD.wellpad_components[i].pos = FD.wellpad_components[i].pos - Shift + [0,0,3];
-
-	'''
-	FD.inflight_data['x'] = FD.inflight_data['x'] - min_x;
-	FD.inflight_data['y'] = FD.inflight_data['y'] - min_y;
-	FD.inflight_data['z'] = FD.inflight_data['z'] - min_z;
-	'''
+	#add 3m to the z component of the component location since we don't have the real height of the components
+	#(component.pos are views of FD.component_positions, so they move with it)
+	Shift = [min_x-Padding[0], min_y-Padding[0],0];
+	FD.component_positions += np.array([0,0,3]) - Shift;
+	if InflightFile is not None:
+		FD.inflight_data['x'] = FD.inflight_data['x'] - Shift[0];
+		FD.inflight_data['y'] = FD.inflight_data['y'] - Shift[1];
 
 	#define the size of the wellpad, in meters
-	size = [max_x-(min_x)+60, max_y-(min_y)+60, max_z+6];
+	size = [max_x-(min_x)+Padding[0]+Padding[1], max_y-(min_y)+Padding[0]+Padding[1], max_z+Padding[2]];
 	print(size)
 
-	#try changing these numbers as necessary
-	grid_size = (200,200,20);
-
 	#define wind speed as initial speed
 	#may want to change this to use current wind speed in future
 	#also need to check that wind direction is defined the way we think
@@ -73,15 +71,28 @@ def FindP_WellPad(Plot_P = True, WellPadNumber = 1, WindSpeed = 2, WindDirection
 		WindSpeed = FD.inflight_data['wind_speeds'][0];
 		WindDirection = FD.inflight_data['wind_directions'][0];
 
-	Dist = ProbDist(size, grid_size, FD.wellpad_components, WindSpeed, WindDirection);
-	Spacing = [size[0]/grid_size[0], size[1]/grid_size[1], size[2]/grid_size[2]];
+	if Cache is not None and Key is None:
+		Key, WindSpeed, WindDirection, Hit = CacheLookup();
+
+	if Hit is not None:
+		P, Spacing, Shift = Hit;
+	else:
+		if Cache is not None:
+			P_file = Cache.TempPath(Key);
+		#with wind samples the single wind field is never used, so it is not computed (nor written to P_file)
+		Dist = ProbDist(size, grid_size, FD.wellpad_components, WindSpeed, WindDirection, dtype=P_dtype, P_file=P_file, Shift=Shift,
+		                compute=WindSamples is None);
+		if WindSamples is not None:
+			Dist.EnsembleUpdate(WindSamples[0], WindSamples[1]);
+		P = Dist.P;
+		Spacing = [size[0]/grid_size[0], size[1]/grid_size[1], size[2]/grid_size[2]];
+		if Cache is not None:
+			Cache.Commit(Key, P_file);
 
 	if Plot_P:
-		#define a 2D array that is a layer of the probability distribution
-		P_layer = np.zeros((grid_size[0], grid_size[1]))
-		for i in range(grid_size[0]):
-			for j in range(grid_size[1]):
-				P_layer[i,j] = Dist.P[i,j,9];
+		#define a 2D array that is a layer of the probability distribution (the 10th, or the top one on shorter grids)
+		layer = min(9, grid_size[2]-1);
+		P_layer = np.asarray(P[:,:,layer]);
 
 		X = np.zeros(grid_size[0])
 		Y = np.zeros(grid_size[1])
@@ -101,4 +112,4 @@ def FindP_WellPad(Plot_P = True, WellPadNumber = 1, WindSpeed = 2, WindDirection
 		plt.title('Initial Probability Distribution for Well Pad {}'.format(WellPadNumber))
 		plt.show()
 
-	return Dist.P, Spacing, Shift
+	return P, Spacing, Shift
@@ -1,10 +1,16 @@
-from tsp_solver.greedy import solve_tsp
-import matplotlib.pyplot as plt
-import matplotlib.patches as ptch
+from tsp_solver.greedy_numpy import solve_tsp
 import math
 import numpy as np
 from scipy import interpolate
-from mathutils.geometry import intersect_point_line
+from scipy.spatial.distance import pdist, squareform
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+# Buffer distances kept around the components
+TankBuffer = 3
+PrismBuffer = 4
+# Angle between two points of an arc around a tank (radians)
+ArcStep = .1
 
 
 # Contains details about a wellpad component used for path generation
@@ -20,94 +26,414 @@ class Object:
 
      # Find the distance of a path around an object between two waypoints
      ## This function only uses the 2D coordinates of the object and path
+     ## For a tank the arc path around it is returned, for a prism the distance around its perimeter
      def AvoidanceDistance(self, p1, p2):
-          path = [] 
-          x1 = p1[0:2]
-          x2 = p2[0:2]
-          # Only two shapes: cylinder and rectangular prism
+          obstacles = Obstacles([self])
+          x1 = np.asarray(p1, dtype=float)[0:2]
+          x2 = np.asarray(p2, dtype=float)[0:2]
           if(self.shape == 'tank'):
-               # Buffer distance
-               r = self.bounds + 3
-               center = self.location[0:2]
-
-               # Calculate the distance from the path to the center of the cylinder
-               nearest_point = intersect_point_line(center,x1,x2)
-               # Test if nearest point is on the line segment
-               if(nearest_point[1] < 0 or nearest_point[1] > 1):
-                    return 0
-
-               nearest_point_vector = np.array(nearest_point[0][:] - center)
-
-               dist_to_center = np.linalg.norm(nearest_point_vector)
-               theta = math.atan2(nearest_point_vector[1], nearest_point_vector[0])
-
-               
-               # Line does not intersect cylinder
-               if(dist_to_center > r):
+               cost, theta, arc, reverse = CylinderDetours(x1, x2, obstacles.centers[0], obstacles.radii[0])
+               if cost == 0:
                     return 0
-               # Return arc path
-               else:
-                    P = x2 - x1
-                    Q = center - x1
-                    phi = np.dot(P,Q)/(np.linalg.norm(P)*np.linalg.norm(Q))
-                    
-                    arc = math.acos(dist_to_center/r)
-                    if(phi < 0):
-                         angles = np.arange(theta - arc, theta + arc,.1)
-                    else:
-                         angles = np.arange(theta + arc, theta - arc,-.1)
-                    for angle in angles:
-                         path.append([r*math.cos(angle), r*math.sin(angle)] + center)
-                    return path
-
-          ## At the moment, this returns the distance around the perimeter the quad would go, not the path
+               return list(ArcPath(obstacles.centers[0], obstacles.radii[0], theta, arc, reverse))
           else:
-               # Expand the bounds by 4m
-               ## This will not work if the bounds coordinates are not ordered correclty
-               o1 = np.array(self.bounds[0] - 4*np.sign(self.bounds[0]))
-               o2 = np.array(self.bounds[1] + 4*np.sign(self.bounds[1]))
-
-               # Create a rectangle of line segments
-               rect = np.array([
-                              [o1, np.array([o2[0], o1[1]]) ], 
-                              [ np.array([o2[0], o1[1]]), o2 ], 
-                              [ np.array([o1[0], o2[1]]), o2 ], 
-                              [ o1, np.array([o1[0], o2[1]]) ]
-                              ])
-
-               # Find the points at which the path intersects the prism 
-               points = []
-               s = x2 - x1
-               for segment in rect:
-                    r = segment[1] - segment[0]
-
-                    # Calculate location of point at which the lines intersect
-                    u = np.cross(s,r)
-                    if u == 0:
-                         continue
-                    p = x1 + s*np.cross((segment[0] - x1), r/u)
-                    
-                    # Test if the point lies on the segment
-                    if (all(p >= segment[0]) and all(p <= segment[1])):
-                         points.append(p)
-                         if len(points) == 2:
-                              break
-               
-               points = np.asarray(points)
-
-               # If no points of intersection are found, the path doesn't intersect the object
-               if points.size > 2:
-                    # The distance along the perimeter will be used to calculate the avoidance distance
-                    perimeter = 2*(np.linalg.norm(o2 - [o1[0], o2[1]]) + np.linalg.norm(o2 - [o2[0], o1[1]]))
-
-                    diag_rect = np.linalg.norm([o2 - o1])
-                    diag_points = np.linalg.norm([points[1] - points[0]])
-
-                    return (diag_points/diag_rect)*perimeter
-
-               return 0
-
-def GeneratePath(x, WellpadComponents, WindDir):
+               cost, t_in, t_out = PrismDetours(x1, x2, obstacles.lower[0], obstacles.upper[0])
+               return float(cost)
+
+
+# Array form of a list of Objects, so that many path segments can be tested against all of them at once
+## cell_size sets the cells of the spatial index over the obstacles (default: the median obstacle footprint)
+class Obstacles:
+     def __init__(self, equipment, cell_size=None):
+          self.equipment = list(equipment)
+          self.shapes = [obj.shape for obj in self.equipment]
+
+          # Tanks: buffered circles
+          tanks = [obj for obj in self.equipment if obj.shape == 'tank']
+          self.tank_index = np.array([k for k, obj in enumerate(self.equipment) if obj.shape == 'tank'], dtype=int)
+          self.centers = np.array([np.asarray(obj.location, dtype=float)[0:2] for obj in tanks]).reshape(-1, 2)
+          self.radii = np.array([obj.bounds for obj in tanks], dtype=float).reshape(-1) + TankBuffer
+
+          # Prisms: buffered rectangles
+          ## This will not work if the bounds coordinates are not ordered correclty
+          prisms = [obj for obj in self.equipment if obj.shape != 'tank']
+          self.prism_index = np.array([k for k, obj in enumerate(self.equipment) if obj.shape != 'tank'], dtype=int)
+          self.lower = np.array([np.asarray(obj.bounds[0], dtype=float)[0:2] for obj in prisms]).reshape(-1, 2)
+          self.upper = np.array([np.asarray(obj.bounds[1], dtype=float)[0:2] for obj in prisms]).reshape(-1, 2)
+          self.lower = self.lower - PrismBuffer*np.sign(self.lower)
+          self.upper = self.upper + PrismBuffer*np.sign(self.upper)
+
+          # Spatial index over the footprints: tanks are numbered first, then prisms
+          self.grid = ObstacleGrid(np.concatenate([self.centers - self.radii[:, None], self.lower]),
+                                   np.concatenate([self.centers + self.radii[:, None], self.upper]), cell_size)
+          # Number of segment vs obstacle tests done and skipped thanks to the index
+          self.stats = {'tests': 0, 'culled': 0}
+
+     # Detour distance of each segment p1[k] -> p2[k], summed over all obstacles
+     ## With chords, the length of the parts of the segments inside the obstacles they go around is returned as well
+     ## With use_index, each segment is only tested against the obstacles found near it in the spatial index;
+     ## otherwise against all of them. Segments are tested in chunks so that the arrays stay small
+     def Costs(self, p1, p2, chunk_size=2**20, use_index=True, chords=False):
+          p1 = np.asarray(p1, dtype=float)[:, 0:2]
+          p2 = np.asarray(p2, dtype=float)[:, 0:2]
+          cost = np.zeros(len(p1))
+          chord = np.zeros(len(p1))
+          if use_index:
+               T = len(self.radii)
+               for k in range(0, len(p1), 2**16):
+                    a = p1[k:k + 2**16]
+                    b = p2[k:k + 2**16]
+                    segment, obstacle = self.grid.Candidates(a, b)
+                    tank = obstacle < T
+                    s, o = segment[tank], obstacle[tank]
+                    c, l = TankCrossings(a[s], b[s], self.centers[o], self.radii[o])
+                    cost[k:k + 2**16] += np.bincount(s, c, minlength=len(a))
+                    chord[k:k + 2**16] += np.bincount(s, l, minlength=len(a))
+                    s, o = segment[~tank], obstacle[~tank] - T
+                    c, l = PrismCrossings(a[s], b[s], self.lower[o], self.upper[o])
+                    cost[k:k + 2**16] += np.bincount(s, c, minlength=len(a))
+                    chord[k:k + 2**16] += np.bincount(s, l, minlength=len(a))
+                    self.stats['tests'] += len(segment)
+                    self.stats['culled'] += len(a)*len(self.equipment) - len(segment)
+          else:
+               step = max(1, chunk_size//max(1, len(self.equipment)))
+               for k in range(0, len(p1), step):
+                    a = p1[k:k + step, None]
+                    b = p2[k:k + step, None]
+                    for c, l in [TankCrossings(a, b, self.centers, self.radii), PrismCrossings(a, b, self.lower, self.upper)]:
+                         cost[k:k + step] += c.sum(axis=1)
+                         chord[k:k + step] += l.sum(axis=1)
+
+          if chords:
+               return cost, chord
+          return cost
+
+     # Points of the path around every obstacle blocking the segment p1 -> p2, in the order of the equipment
+     def DetourPath(self, p1, p2):
+          x1 = np.asarray(p1, dtype=float)[0:2]
+          x2 = np.asarray(p2, dtype=float)[0:2]
+          pieces = {}
+          if len(self.radii):
+               cost, theta, arc, reverse = CylinderDetours(x1, x2, self.centers, self.radii)
+               for k in np.flatnonzero(cost):
+                    pieces[self.tank_index[k]] = ArcPath(self.centers[k], self.radii[k], theta[k], arc[k], reverse[k])
+          if len(self.lower):
+               cost, t_in, t_out = PrismDetours(x1, x2, self.lower, self.upper)
+               for k in np.flatnonzero(cost):
+                    pieces[self.prism_index[k]] = PerimeterPath(self.lower[k], self.upper[k], x1 + t_in[k]*(x2 - x1), x1 + t_out[k]*(x2 - x1))
+          path = []
+          for k in sorted(pieces):
+               path.extend(pieces[k])
+          return path
+
+
+# Uniform grid over the footprints (boxes lower - upper) of the obstacles
+## Segments are sampled every cell_size, so every point of a segment is within cell_size/2 of a sample; each footprint
+## is registered in every cell it reaches once grown by cell_size/2, so an obstacle crossed by a segment is always
+## registered in the cell of one of its samples
+class ObstacleGrid:
+     def __init__(self, lower, upper, cell_size=None):
+          self.count = len(lower)
+          if cell_size is None:
+               cell_size = np.median(np.max(upper - lower, axis=1)) if self.count else 1.
+          self.cell_size = float(cell_size) if cell_size > 0 else 1.
+          h = self.cell_size
+
+          lower = lower - h/2
+          upper = upper + h/2
+          self.origin = np.min(lower, axis=0) if self.count else np.zeros(2)
+          first = np.floor((lower - self.origin)/h).astype(np.int64)
+          last = np.floor((upper - self.origin)/h).astype(np.int64)
+          self.shape = np.max(last, axis=0) + 1 if self.count else np.zeros(2, dtype=np.int64)
+          self.cells = int(np.prod(self.shape))
+
+          # (cell, obstacle) registrations, sorted by cell; the obstacles of cell c are obstacles[start[c]:start[c+1]]
+          ## A footprint inverted on an axis by more than a cell covers no cell
+          width = np.maximum(last - first + 1, 0)
+          counts = np.prod(width, axis=1)
+          obstacle = np.repeat(np.arange(self.count), counts)
+          k = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+          cell = (first[obstacle, 0] + k//width[obstacle, 1])*self.shape[1] + first[obstacle, 1] + k % width[obstacle, 1]
+          order = np.argsort(cell, kind='stable')
+          self.obstacles = obstacle[order]
+          self.start = np.searchsorted(cell[order], np.arange(self.cells + 1))
+
+     # Segment and obstacle indices of the (segment, obstacle) pairs that have to be tested, sorted by segment
+     def Candidates(self, p1, p2):
+          h = self.cell_size
+          length = np.hypot(*(p2 - p1).T)
+          samples = np.floor(length/h).astype(np.int64) + 2
+          segment = np.repeat(np.arange(len(p1)), samples)
+          k = np.arange(np.sum(samples)) - np.repeat(np.cumsum(samples) - samples, samples)
+          t = k/(samples - 1)[segment]
+          cell = np.floor((p1[segment] + t[:, None]*(p2 - p1)[segment] - self.origin)/h).astype(np.int64)
+          inside = np.all((cell >= 0) & (cell < self.shape), axis=1)
+          segment = segment[inside]
+          cell = cell[inside, 0]*self.shape[1] + cell[inside, 1]
+
+          # Cells visited by each segment: a straight segment never comes back to a cell, so repeated cells are consecutive
+          new = np.ones(len(cell), dtype=bool)
+          new[1:] = (segment[1:] != segment[:-1]) | (cell[1:] != cell[:-1])
+          segment, cell = segment[new], cell[new]
+
+          # Obstacles registered in those cells, once per segment
+          counts = self.start[cell + 1] - self.start[cell]
+          k = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(self.start[cell], counts)
+          key = np.sort(np.repeat(segment, counts)*self.count + self.obstacles[k])
+          new = np.ones(len(key), dtype=bool)
+          new[1:] = key[1:] != key[:-1]
+          key = key[new]
+          return key//self.count, key % self.count
+
+
+# Segment vs cylinder test; all arguments broadcast against each other (points have a last axis of size 2)
+## Returns the length of the arc path around the buffered circle (0 if the segment does not cross it) and the
+## parameters of that arc for ArcPath
+def CylinderDetours(p1, p2, centers, radii):
+     s = p2 - p1
+     q = centers - p1
+     sq = np.sum(s*q, axis=-1)
+     with np.errstate(divide='ignore', invalid='ignore'):
+          # Parameter of the point of the line nearest to the center; nan for a zero length segment
+          t = sq/np.sum(s*s, axis=-1)
+          nearest = p1 + t[..., None]*s
+          v = nearest - centers
+          dist_to_center = np.hypot(v[..., 0], v[..., 1])
+          theta = np.arctan2(v[..., 1], v[..., 0])
+          # Test if nearest point is on the line segment and inside the circle
+          hit = (t >= 0) & (t <= 1) & (dist_to_center <= radii)
+          arc = np.where(hit, np.arccos(np.clip(dist_to_center/radii, -1, 1)), 0.)
+
+     # The arc is sampled every ArcStep radians, as np.arange(theta - arc, theta + arc, ArcStep); the path length is the
+     # number of chords times the chord length
+     samples = np.where(hit, np.ceil(((theta + arc) - (theta - arc))/ArcStep), 0)
+     cost = np.maximum(samples - 1, 0)*2*radii*math.sin(ArcStep/2)
+     # The arc is walked from theta + arc down to theta - arc when the center is ahead of p1
+     reverse = sq >= 0
+     return cost, theta, arc, reverse
+
+# Detour distance around tanks and length of the segment inside the circles it goes around
+def TankCrossings(p1, p2, centers, radii):
+     cost, theta, arc, reverse = CylinderDetours(p1, p2, centers, radii)
+     return cost, np.where(cost > 0, 2*radii*np.sin(arc), 0.)
+
+# Points of the arc path around a tank
+def ArcPath(center, r, theta, arc, reverse):
+     if reverse:
+          angles = np.arange(theta + arc, theta - arc, -ArcStep)
+     else:
+          angles = np.arange(theta - arc, theta + arc, ArcStep)
+     return np.stack([r*np.cos(angles), r*np.sin(angles)], axis=-1) + center
+
+# Segment vs rectangle test; all arguments broadcast against each other (points have a last axis of size 2)
+## Returns the avoidance distance (length of the crossing relative to the diagonal, times the perimeter; 0 if the
+## segment does not cross the rectangle) and the segment parameters where it enters and leaves the rectangle
+def PrismDetours(p1, p2, lower, upper):
+     s = p2 - p1
+     with np.errstate(divide='ignore', invalid='ignore'):
+          t_lower = (lower - p1)/s
+          t_upper = (upper - p1)/s
+     t_near = np.minimum(t_lower, t_upper)
+     t_far = np.maximum(t_lower, t_upper)
+     # A segment parallel to a side is inside that slab everywhere or nowhere
+     parallel = s == 0
+     inside = (p1 >= lower) & (p1 <= upper)
+     t_near = np.where(parallel, np.where(inside, -np.inf, np.inf), t_near)
+     t_far = np.where(parallel, np.where(inside, np.inf, -np.inf), t_far)
+     t_in = np.maximum(np.max(t_near, axis=-1), 0)
+     t_out = np.minimum(np.min(t_far, axis=-1), 1)
+     # A box left inverted (lower > upper) by the sign based buffer of Obstacles is empty
+     t_out = np.where(np.any(lower > upper, axis=-1), -np.inf, t_out)
+     hit = t_in < t_out
+
+     # The distance along the perimeter will be used to calculate the avoidance distance
+     size = upper - lower
+     perimeter = 2*np.sum(size, axis=-1)
+     diag_rect = np.hypot(size[..., 0], size[..., 1])
+     diag_points = (t_out - t_in)*np.hypot(s[..., 0], s[..., 1])
+     cost = np.where(hit, diag_points/diag_rect*perimeter, 0.)
+     return cost, t_in, t_out
+
+# Avoidance distance around prisms and length of the segment inside the rectangles it goes around
+def PrismCrossings(p1, p2, lower, upper):
+     cost, t_in, t_out = PrismDetours(p1, p2, lower, upper)
+     return cost, np.where(cost > 0, (t_out - t_in)*np.linalg.norm(p2 - p1, axis=-1), 0.)
+
+# Points of the shorter way around the perimeter of a rectangle from the entry point a to the exit point b
+def PerimeterPath(lower, upper, a, b):
+     corners = np.array([lower, [upper[0], lower[1]], upper, [lower[0], upper[1]]])
+     size = upper - lower
+     perimeter = 2*np.sum(size)
+     # Distance of the corners and of the points along the perimeter, counterclockwise from the lower corner
+     offsets = np.array([0, size[0], size[0] + size[1], 2*size[0] + size[1]])
+     def position(p):
+          # Position of the nearest point of the perimeter
+          d = np.abs([p[1] - lower[1], upper[0] - p[0], upper[1] - p[1], p[0] - lower[0]])
+          side = np.argmin(d)
+          along = [p[0] - lower[0], p[1] - lower[1], upper[0] - p[0], upper[1] - p[1]][side]
+          return offsets[side] + np.clip(along, 0, size[side % 2])
+     start = position(a)
+     forward = (position(b) - start) % perimeter
+     if forward <= perimeter/2:
+          passed = [k for k in range(4) if 0 < (offsets[k] - start) % perimeter < forward]
+          passed.sort(key=lambda k: (offsets[k] - start) % perimeter)
+     else:
+          passed = [k for k in range(4) if 0 < (start - offsets[k]) % perimeter < perimeter - forward]
+          passed.sort(key=lambda k: (start - offsets[k]) % perimeter)
+     return [np.asarray(a)] + [corners[k] for k in passed] + [np.asarray(b)]
+
+# Paths around the obstacles between pairs of waypoints
+## A path is built the first time it is asked for and then kept, so only the edges that are used cost memory
+class Detours:
+     def __init__(self, x, obstacles):
+          self.x = x
+          self.obstacles = obstacles
+          self.paths = {}
+
+     # Path around the obstacles from waypoint max(i, j) to waypoint min(i, j)
+     def Path(self, i, j):
+          if i < j:
+               i, j = j, i
+          if (i, j) not in self.paths:
+               self.paths[(i, j)] = self.obstacles.DetourPath(self.x[i], self.x[j])
+          return self.paths[(i, j)]
+
+# Shortest obstacle free paths on the visibility graph of the obstacles, built once per pad
+## Each buffered tank is replaced by a polygon with the given number of sides drawn around it, and each rectangle by its
+## corners; two corners are linked if the segment between them crosses no obstacle. Paths between waypoints are found
+## with Dijkstra's algorithm on that graph and cached, so a path can go around several obstacles at once
+class Router:
+     def __init__(self, obstacles, sides=16):
+          self.obstacles = obstacles
+          # Corners are pushed out a little so that the sides of the polygons do not block themselves
+          margin = 1e-6
+          angles = 2*np.pi*np.arange(sides)/sides
+          R = obstacles.radii/math.cos(math.pi/sides)*(1 + margin)
+          tanks = obstacles.centers[:, None] + R[:, None, None]*np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+          lower = obstacles.lower - margin*(1 + np.abs(obstacles.lower))
+          upper = obstacles.upper + margin*(1 + np.abs(obstacles.upper))
+          prisms = np.stack([lower, np.stack([upper[:, 0], lower[:, 1]], axis=-1), upper, np.stack([lower[:, 0], upper[:, 1]], axis=-1)], axis=1)
+          nodes = np.concatenate([tanks.reshape(-1, 2), prisms.reshape(-1, 2)])
+          # Corners inside another obstacle can not be reached
+          self.nodes = nodes[~self.Inside(nodes)]
+
+          i, j = np.triu_indices(len(self.nodes), 1)
+          free = ~self.Blocked(self.nodes[i], self.nodes[j])
+          i, j = i[free], j[free]
+          self.edges = (i, j, np.linalg.norm(self.nodes[i] - self.nodes[j], axis=1))
+          self.routes = {}
+
+     # Whether each point is inside an obstacle
+     def Inside(self, points):
+          inside = np.zeros(len(points), dtype=bool)
+          for center, r in zip(self.obstacles.centers, self.obstacles.radii):
+               inside |= np.linalg.norm(points - center, axis=1) < r
+          for lower, upper in zip(self.obstacles.lower, self.obstacles.upper):
+               inside |= np.all((points > lower) & (points < upper), axis=1)
+          return inside
+
+     # Whether each segment p1[k] -> p2[k] crosses an obstacle, tested against the obstacles near it in the spatial index
+     ## With free_ends, an obstacle that contains an end of the segment does not block it, so that a waypoint inside a
+     ## buffer can still leave it
+     def Blocked(self, p1, p2, free_ends=False):
+          blocked = np.zeros(len(p1), dtype=bool)
+          T = len(self.obstacles.radii)
+          for k in range(0, len(p1), 2**16):
+               a = p1[k:k + 2**16]
+               b = p2[k:k + 2**16]
+               segment, obstacle = self.obstacles.grid.Candidates(a, b)
+               tank = obstacle < T
+               s, o = segment[tank], obstacle[tank]
+               hit = SegmentCrossesCircle(a[s], b[s], self.obstacles.centers[o], self.obstacles.radii[o], free_ends)
+               blocked[k + s[hit]] = True
+               s, o = segment[~tank], obstacle[~tank] - T
+               hit = SegmentCrossesRectangle(a[s], b[s], self.obstacles.lower[o], self.obstacles.upper[o], free_ends)
+               blocked[k + s[hit]] = True
+               self.obstacles.stats['tests'] += len(segment)
+               self.obstacles.stats['culled'] += len(a)*len(self.obstacles.equipment) - len(segment)
+          return blocked
+
+     # Shortest paths between the waypoints x (cached)
+     def Routes(self, x):
+          x = np.ascontiguousarray(np.asarray(x, dtype=float)[:, 0:2])
+          key = x.tobytes()
+          if key not in self.routes:
+               self.routes[key] = Routes(self, x)
+          return self.routes[key]
+
+# Shortest obstacle free paths between every pair of a set of waypoints, from Router.Routes
+## Distances holds their lengths and Blocked the pairs that can not be flown in a straight line
+## A pair that can not be linked at all (e.g. a waypoint walled in by overlapping obstacles) is flown in a straight line
+class Routes:
+     def __init__(self, router, x):
+          self.router = router
+          self.x = x
+          N, V = len(x), len(router.nodes)
+
+          # Waypoints are linked to the corners they see
+          w = np.repeat(np.arange(N), V)
+          v = np.tile(np.arange(V), N)
+          free = ~router.Blocked(x[w], router.nodes[v], free_ends=True)
+          w, v = w[free], v[free]
+          i, j, lengths = router.edges
+          graph = csr_matrix((np.concatenate([lengths, np.linalg.norm(x[w] - router.nodes[v], axis=1)]),
+                              (np.concatenate([i, V + w]), np.concatenate([j, v]))), shape=(V + N, V + N))
+          dist, self.predecessors = dijkstra(graph, directed=False, indices=V + np.arange(N), return_predecessors=True)
+
+          i, j = np.tril_indices(N, -1)
+          self.Blocked = np.zeros((N, N), dtype=bool)
+          self.Blocked[i, j] = router.Blocked(x[i], x[j], free_ends=True)
+          self.Blocked &= np.isfinite(dist[:, V:])
+          self.Blocked |= self.Blocked.T
+          self.Distances = np.where(self.Blocked, dist[:, V:], squareform(pdist(x)))
+          self.paths = {}
+
+     # Corners of the shortest path from waypoint max(i, j) to waypoint min(i, j)
+     def Path(self, i, j):
+          if i < j:
+               i, j = j, i
+          if (i, j) not in self.paths:
+               V = len(self.router.nodes)
+               path = []
+               if self.Blocked[i, j]:
+                    node = self.predecessors[i, V + j]
+                    while node != V + i:
+                         path.append(self.router.nodes[node] if node < V else self.x[node - V])
+                         node = self.predecessors[i, node]
+                    path.reverse()
+               self.paths[(i, j)] = path
+          return self.paths[(i, j)]
+
+# Whether segments cross the inside of circles; all arguments broadcast against each other
+## With free_ends, a circle that contains an end of the segment does not count
+def SegmentCrossesCircle(p1, p2, centers, radii, free_ends=False):
+     s = p2 - p1
+     q = centers - p1
+     ss = np.sum(s*s, axis=-1)
+     # Point of the segment nearest to the center
+     t = np.clip(np.sum(s*q, axis=-1)/np.where(ss > 0, ss, 1), 0, 1)
+     crosses = np.linalg.norm(p1 + t[..., None]*s - centers, axis=-1) < radii
+     if free_ends:
+          crosses &= (np.linalg.norm(q, axis=-1) >= radii) & (np.linalg.norm(centers - p2, axis=-1) >= radii)
+     return crosses
+
+# Whether segments cross the inside of rectangles; all arguments broadcast against each other
+## With free_ends, a rectangle that contains an end of the segment does not count
+def SegmentCrossesRectangle(p1, p2, lower, upper, free_ends=False):
+     cost, t_in, t_out = PrismDetours(p1, p2, lower, upper)
+     crosses = t_in < t_out
+     if free_ends:
+          crosses &= ~np.all((p1 > lower) & (p1 < upper), axis=-1) & ~np.all((p2 > lower) & (p2 < upper), axis=-1)
+     return crosses
+
+def GeneratePath(x, WellpadComponents, WindDir, filename=None, ClimbCost=0, Routing='arcs'):
+     # Plans the path and plots it; see PlanPath for planning without plotting
+     Path, Tour, EdgeCosts, Stats = PlanPath(x, WellpadComponents, WindDir, ClimbCost, Routing)
+     RenderPath(Path, x, WellpadComponents, filename)
+     return Path
+
+# Objects used for path generation from the wellpad components
+def Equipment(WellpadComponents):
      """
      Insert code to either read stored data on the wellpad components or load
      data from kml files. This depends on how we want to structure our code.
@@ -126,10 +452,30 @@ def GeneratePath(x, WellpadComponents, WindDir):
           
           obj = Object(.1, 'tank', component.pos)
           equipment.append(obj)
-     
-     for point in x:
-          point[0] += 4*math.cos(WindDir*math.pi/180)
-          point[1] += 4*math.sin(WindDir*math.pi/180) 
+     return equipment
+
+# Straight line distance between every pair of waypoints, as a dense symmetric matrix
+## With a ClimbCost, each meter of altitude change between the waypoints costs that much more
+def DistanceMatrix(x, ClimbCost=0):
+     x = np.asarray(x, dtype=float)
+     d = pdist(x[:, 0:2])
+     if ClimbCost and x.shape[1] > 2:
+          d += ClimbCost*pdist(x[:, 2:3], 'cityblock')
+     return squareform(d)
+
+# Headless path generation: nothing is plotted and matplotlib is never imported
+## Returns the x,y coordinates of the path, the order in which the waypoints are visited and the cost of each edge of
+## that closed tour (edge k goes from Tour[k] to Tour[k+1], the last one back to Tour[0]), and the number of segment vs
+## obstacle tests done and culled by the spatial index (Obstacles.stats; a reused Router counts all the pads it planned)
+## The cost of an edge is its length (see DistanceMatrix), plus the extra length of the way around the objects blocking it
+## Routing 'arcs' goes around each blocking object on its own; 'visibility' (or a Router of the pad, to reuse it) takes
+## the shortest path around all of them on a visibility graph
+## The waypoints x are moved 4m downwind in place
+def PlanPath(x, WellpadComponents, WindDir, ClimbCost=0, Routing='arcs'):
+     equipment = Equipment(WellpadComponents)
+
+     x[:,0] += 4*math.cos(WindDir*math.pi/180)
+     x[:,1] += 4*math.sin(WindDir*math.pi/180)
      """
      # Test Waypoints
      x = 40*np.random.rand(5,2)
@@ -143,42 +489,30 @@ def GeneratePath(x, WellpadComponents, WindDir):
           equipment.append(o)
      """     
 
-     # Stores the distances between waypoints
-     Distance_Matrix = []
-     # Stores whether or not a path is blocked by an object
-     Avoidance_Matrix = []
-     # Stores paths around objects
-     Path_Matrix = []
-
-     for i in range(0,x[:,0].size):
-          # Stores the distance from one waypoint to all other waypoints
-          edge_dist = []
-          # Stores booleans of whether or not an object blocks the path between waypoints.
-          objects_in_path = []
-          # Stores a path around any interfering objects
-          Avoiding_Path = []
-
-          for j in range(0,i):
-               # Total distance around objects in path
-               dist = 0
-               path_around_obj = []
-               for obj in equipment:
-                    path_1 = obj.AvoidanceDistance(x[i], x[j])
-                    if path_1 != 0:
-                         for d in path_1:
-                              path_around_obj.append(d)
-                         for p in range(1,len(path_1)):
-                              dist += np.linalg.norm(path_1[p] - path_1[p-1])
-               
-               edge_dist.append(dist)
-               objects_in_path.append(dist > 0)
-               Avoiding_Path.append(path_around_obj)
-          
-          Path_Matrix.append(Avoiding_Path)
-          Distance_Matrix.append(edge_dist)
-          Avoidance_Matrix.append(objects_in_path)
+     # Stores the cost of flying between waypoints
+     Distance_Matrix = DistanceMatrix(x, ClimbCost)
+
+     if Routing == 'arcs':
+          # Detour distance of every pair of waypoints i > j, computed for all pairs and obstacles at once
+          obstacles = Obstacles(equipment)
+          N = x[:,0].size
+          i, j = np.tril_indices(N, -1)
+          detour, chord = obstacles.Costs(x[i], x[j], chords=True)
+          extra = np.maximum(detour - chord, 0)
+          Distance_Matrix[i, j] += extra
+          Distance_Matrix[j, i] += extra
+          # Stores whether or not a path is blocked by an object
+          Blocked = np.zeros((N, N), dtype=bool)
+          Blocked[i, j] = detour > 0
+          # Paths around objects, only built for the edges of the tour
+          detours = Detours(x, obstacles)
+     else:
+          router = Routing if isinstance(Routing, Router) else Router(Obstacles(equipment))
+          obstacles = router.obstacles
+          detours = router.Routes(x)
+          Distance_Matrix += detours.Distances - DistanceMatrix(x)
+          Blocked = detours.Blocked
 
-     Path_Matrix = np.asarray(Path_Matrix)
      path = solve_tsp(Distance_Matrix)
      x_ = [x[path[0]][0]]
      y_ = [x[path[0]][1]]
@@ -190,11 +524,11 @@ def GeneratePath(x, WellpadComponents, WindDir):
                path1 = path[i]
                path2 = path[i-1]
 
-          if Avoidance_Matrix[path1][path2]:
-               path_to_add = np.asarray(Path_Matrix[path1][path2])
+          if Blocked[path1][path2]:
+               path_to_add = np.asarray(detours.Path(path1, path2))
                # Flip the array if the path order is opposite to the append direction
-               if (np.linalg.norm(path_to_add[len(path_to_add) - 1] - [x_[-1], y_[-1]] < \
-                    np.linalg.norm(path_to_add[0] - [x_[-1], y_[-1]]))):
+               if (np.linalg.norm(path_to_add[len(path_to_add) - 1] - [x_[-1], y_[-1]]) < \
+                    np.linalg.norm(path_to_add[0] - [x_[-1], y_[-1]])):
                     path_to_add = np.flipud(path_to_add)
 
                for point in path_to_add:
@@ -213,11 +547,11 @@ def GeneratePath(x, WellpadComponents, WindDir):
           path1 = path[0]
           path2 = path[-1]
 
-     if Avoidance_Matrix[path1][path2]:
-          path_to_add = np.asarray(Path_Matrix[path1][path2])
+     if Blocked[path1][path2]:
+          path_to_add = np.asarray(detours.Path(path1, path2))
           # Flip the array if the path order is opposite to the append direction
-          if (np.linalg.norm(path_to_add[len(path_to_add) - 1] - [x_[-1], y_[-1]] < \
-               np.linalg.norm(path_to_add[0] - [x_[-1], y_[-1]]))):
+          if (np.linalg.norm(path_to_add[len(path_to_add) - 1] - [x_[-1], y_[-1]]) < \
+               np.linalg.norm(path_to_add[0] - [x_[-1], y_[-1]])):
                path_to_add = np.flipud(path_to_add)
 
           for point in path_to_add:
@@ -226,7 +560,19 @@ def GeneratePath(x, WellpadComponents, WindDir):
                
      x_.append(x[path[0]][0])
      y_.append(x[path[0]][1])
-     np.append(x,x[0])
+
+     EdgeCosts = Distance_Matrix[path, np.roll(path, -1)]
+     return np.array([x_, y_]), path, EdgeCosts, dict(obstacles.stats)
+
+# Plots a path from PlanPath with the waypoints and the wellpad components
+## The figure is written to filename if one is given, otherwise it is shown
+def RenderPath(Path, x, WellpadComponents, filename=None):
+     import matplotlib.pyplot as plt
+     import matplotlib.patches as ptch
+
+     equipment = Equipment(WellpadComponents)
+     x_, y_ = Path
+     fig = plt.figure()
      #Path Plotting with Objects
      plt.plot(x_,y_,'-o')
      #for i in path:
@@ -238,7 +584,7 @@ def GeneratePath(x, WellpadComponents, WindDir):
 
      for obj in equipment:
           if obj.shape == 'tank':
-               ax.add_patch(ptch.Circle(obj.location, obj.bounds))
+               ax.add_patch(ptch.Circle(obj.location[0:2], obj.bounds))
           else:
                ax.add_patch(ptch.Rectangle(obj.bounds[0] - 4*np.sign(obj.bounds[0]),\
                     4*(obj.bounds[1][0] - obj.bounds[0][0]), \
@@ -259,6 +605,8 @@ def GeneratePath(x, WellpadComponents, WindDir):
 
 
      plt.tight_layout()
-     plt.show()
-
-     return np.array([x_, y_])
\ No newline at end of file
+     if filename is not None:
+          fig.savefig(filename)
+          plt.close(fig)
+     else:
+          plt.show()
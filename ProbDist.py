@@ -1,5 +1,10 @@
 import numpy as np 
-from math import isnan
+from math import isnan, erf, sqrt
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+import json
 
 class ProbDist:
 	def __init__(self, 
@@ -7,23 +12,122 @@ class ProbDist:
 		         grid_size, #(n_L, n_W, n_H) tuple with number of grid points in each direction
 		         LeakPoints, #list of points where we are assuming there might be a point source leak
 		         v_wind, #current wind speed
-		         wind_dir #current wind direction; we assume this an angle counter clockwise relative to the positive x axis
-		         ): 
+		         wind_dir, #current wind direction; we assume this an angle counter clockwise relative to the positive x axis
+		         chunk_size = 2**21, #maximum number of (leak, cell) values evaluated at once by ComputeDistribution
+		         field_cache = 8, #number of wind directions whose unit wind speed field is kept for WindSpeedUpdate
+		                          #(none when dtype or P_file is given, since each cached field is a full float64 grid)
+		         truncate = None, #if given, each plume is only evaluated within this many sigma_y/sigma_z of its axis
+		         workers = None, #if more than 1, the grid is built by a process pool with this many workers
+		         dtype = np.float64, #storage type of P; np.float32 halves its memory
+		         P_file = None, #if given, P is a memory-mapped .npy file at this path (see LoadDistribution)
+		         Shift = (0,0,0), #position of the grid origin in well pad coordinates, stored with P_file
+		         compute = True #if False, P stays None until WindSpeedUpdate or EnsembleUpdate computes it
+		         ):
 		
 		self.size = size;
 		self.grid_size = grid_size;
 		self.LeakPoints = LeakPoints;
 		self.v_wind = v_wind;
 		self.wind_dir = wind_dir*2*np.pi/(360.);
+		self.chunk_size = chunk_size;
+		self.field_cache = field_cache if P_file is None and np.dtype(dtype) == np.float64 else 0;
+		self.FieldCache = OrderedDict();
+		self.truncate = truncate;
+		self.workers = workers;
+		self.dtype = dtype;
+		self.P_file = P_file;
+		self.Shift = Shift;
+		self.WindSamples = None; #(speeds, directions, weights) while P is an EnsembleUpdate distribution
+		#upper bound on the fraction of each leak's plume that is dropped by the truncation
+		self.TruncationError = 0. if truncate is None else 1 - erf(truncate/sqrt(2))**2;
 
 		#find increments = [delta_l, delta_w, delta_h]
 		self.increments = [];
 		for i in range(len(size)):
 			self.increments.append(size[i]/grid_size[i])
 
-		self.P = self.ComputeDistribution()
+		self.Offsets = self.CellOffsets();
+		self.P = None;
+		if compute:
+			self.P = self.ComputeDistribution()
 	
 	def ComputeDistribution(self):
+		#vectorized version of ComputeDistributionLoop: the plume term is evaluated for all leaks and grid cells at once,
+		#in blocks of x rows so that no temporary holds more than chunk_size values
+		#the field is at unit wind speed; the 1/v_wind factor is applied by StoreP block by block
+		Field = self.UnitField(self.wind_dir);
+
+		#find sum of value at all points and then divide each point by that number
+		#Scale converts P back into a concentration per unit emission rate
+		self.Scale = np.sum(Field)/self.v_wind;
+
+		return self.StoreP(Field, self.Scale, self.v_wind)
+
+	def StoreP(self, P, Scale, divisor = 1.):
+		#writes P/divisor/Scale into the storage of the distribution (dtype, and the memory-mapped P_file if there is one)
+		#and returns it; the division is done in blocks of rows so no second full-size temporary is made
+		if self.P_file is None:
+			Stored = np.empty(self.grid_size, dtype=self.dtype);
+		elif self.P is not None and self.P.shape == tuple(self.grid_size):
+			Stored = self.P;
+		else:
+			Stored = np.lib.format.open_memmap(self.P_file, mode='w+', dtype=self.dtype, shape=tuple(self.grid_size));
+
+		rows = max(1, self.chunk_size//int(np.prod(self.grid_size[1:])));
+		for i0 in range(0, self.grid_size[0], rows):
+			Stored[i0:i0+rows] = P[i0:i0+rows]/divisor/Scale;
+
+		if self.P_file is not None:
+			Stored.flush();
+			self.WriteMetadata();
+
+		return Stored
+
+	def WriteMetadata(self):
+		#grid metadata stored next to P_file, read back by LoadDistribution
+		Metadata = {'size': [float(s) for s in self.size],
+		            'grid_size': [int(n) for n in self.grid_size],
+		            'spacing': [float(d) for d in self.increments],
+		            'shift': [float(s) for s in self.Shift],
+		            'wind_speed': float(self.v_wind),
+		            'wind_direction': float(self.wind_dir*360./(2*np.pi)),
+		            'scale': float(self.Scale)};
+		with open(_MetadataFile(self.P_file), 'w') as f:
+			json.dump(Metadata, f, indent=1);
+
+	def UnitField(self, wind_dir):
+		#unnormalized plume of all leaks at unit wind speed for a wind direction in radians
+		#the wind speed only scales the field by 1/v_wind, so fields are cached by direction alone
+		key = round(wind_dir, 9);
+		if key in self.FieldCache:
+			self.FieldCache.move_to_end(key);
+			return self.FieldCache[key]
+
+		if self.workers is not None and self.workers > 1:
+			Field = _AccumulatePlumeParallel(self.grid_size, self.Offsets, wind_dir, self.chunk_size, self.truncate, self.workers);
+		else:
+			Field = np.zeros(self.grid_size);
+			_AccumulatePlume(Field, self.Offsets, wind_dir, self.chunk_size, self.truncate);
+
+		if self.field_cache > 0:
+			self.FieldCache[key] = Field;
+			while len(self.FieldCache) > self.field_cache:
+				self.FieldCache.popitem(last=False);
+
+		return Field
+
+	def CellOffsets(self):
+		#per-leak offsets of the grid lines from each leak point, (dx[n,i], dy[n,j], z[k]-H[n], z[k]+H[n])
+		#the offsets do not depend on the wind so they only have to be computed once per leak
+		LP = _LeakPositions(self.LeakPoints);
+		dx = np.arange(self.grid_size[0])*self.increments[0] - LP[:,0:1];
+		dy = np.arange(self.grid_size[1])*self.increments[1] - LP[:,1:2];
+		z = np.arange(self.grid_size[2])*self.increments[2];
+
+		return dx, dy, z - LP[:,2:3], z + LP[:,2:3]
+
+	def ComputeDistributionLoop(self):
+		#reference implementation, one grid cell and one leak at a time
 		#define empty 3d array
 		P = np.zeros(self.grid_size);
 
@@ -61,25 +165,335 @@ class ProbDist:
 
 		return P
 
-	def WindSpeedUpdate(self, new_v_wind, new_wind_dir):
+	def WindSpeedUpdate(self, new_v_wind, new_wind_dir = None):
+		#new_wind_dir is in degrees, like the wind_dir given to the constructor; None keeps the current direction
+		#(after EnsembleUpdate, the direction given to the constructor or to the last WindSpeedUpdate)
+		same_dir = new_wind_dir is None or round(new_wind_dir*2*np.pi/(360.), 9) == round(self.wind_dir, 9);
+		if same_dir and self.P is not None and self.WindSamples is None:
+			#speed-only change: every leak's contribution is scaled by the same 1/v_wind factor,
+			#so the normalized P is unchanged and only the normalization constant is rescaled
+			self.Scale = self.Scale*self.v_wind/new_v_wind;
+			self.v_wind = new_v_wind;
+			if self.P_file is not None:
+				self.WriteMetadata();
+			return
+
 		self.v_wind = new_v_wind;
-		self.wind_dir = new_wind_dir;
+		if new_wind_dir is not None:
+			self.wind_dir = new_wind_dir*2*np.pi/(360.);
+		self.WindSamples = None;
 
+		#the per-leak cell offsets are reused; only the rotation into the wind frame is recomputed
+		#(or nothing at all if this direction is still in the field cache)
 		self.P = self.ComputeDistribution()
 
+	def EnsembleUpdate(self, wind_speeds, wind_directions, weights = None, dir_resolution = 0., n_profiles = 256, threads = None):
+		#sets P to the normalized expected concentration over an ensemble of wind samples,
+		#e.g. FD.inflight_data['wind_speeds'] and FD.inflight_data['wind_directions'] (directions in degrees)
+		#samples are grouped by direction, optionally rounded to dir_resolution degrees, since the speed
+		#only enters as a 1/v weight. The vertical profile of a leak only depends on the downwind distance, so it is
+		#tabulated once per leak at n_profiles distances and shared by every sample; n_profiles = 0 evaluates
+		#each direction exactly instead. The grid is split into slabs of x rows that threads fill in place, so
+		#no thread holds a grid of its own, and each cell sums its leaks in the same order for any number of threads.
+		wind_speeds = np.asarray(wind_speeds, dtype=float).ravel();
+		wind_directions = np.asarray(wind_directions, dtype=float).ravel();
+		if weights is None:
+			weights = np.ones(len(wind_speeds));
+		weights = np.asarray(weights, dtype=float).ravel();
+
+		#samples without a usable wind reading are dropped
+		valid = np.isfinite(wind_speeds) & np.isfinite(wind_directions) & (wind_speeds > 0);
+		if not np.any(valid):
+			raise ValueError('No wind samples with a finite, positive wind speed.')
+		wind_speeds = wind_speeds[valid];
+		wind_directions = wind_directions[valid] % 360.;
+		weights = weights[valid];
+
+		if dir_resolution:
+			wind_directions = (np.round(wind_directions/dir_resolution)*dir_resolution) % 360.;
+		directions, group = np.unique(wind_directions, return_inverse=True);
+		dir_weights = np.bincount(group.ravel(), weights=weights/wind_speeds, minlength=len(directions));
+		directions = directions*2*np.pi/(360.);
+
+		if threads is None:
+			threads = os.cpu_count() or 1;
+
+		#downwind distances at which the vertical profiles are tabulated; closer cells are evaluated exactly
+		if n_profiles:
+			nodes = np.geomspace(0.5*min(self.increments), np.linalg.norm(self.size), n_profiles);
+
+		P = np.zeros(self.grid_size);
+		dx, dy, zm, zp = self.Offsets;
+		def WeightedSum(slab):
+			i0, i1 = slab[0], slab[-1] + 1;
+			Block = P[i0:i1];
+			offsets = (dx[:,i0:i1], dy, zm, zp);
+			if n_profiles:
+				for n in range(len(dx)):
+					_EnsemblePlume(Block, offsets, n, directions, dir_weights, nodes, self.chunk_size);
+				return
+			for d in range(len(directions)):
+				key = round(directions[d], 9);
+				if key in self.FieldCache:
+					Block += dir_weights[d]*self.FieldCache[key][i0:i1];
+				else:
+					Single = np.zeros(Block.shape);
+					_AccumulatePlume(Single, offsets, directions[d], self.chunk_size, self.truncate);
+					Block += dir_weights[d]*Single;
+
+		#NumPy releases the GIL inside the plume evaluation, so the slabs are filled in parallel on threads
+		slabs = [slab for slab in np.array_split(np.arange(self.grid_size[0]), min(self.grid_size[0], 4*threads)) if len(slab)];
+		with ThreadPoolExecutor(max_workers=max(1, min(threads, len(slabs)))) as pool:
+			list(pool.map(WeightedSum, slabs));
+
+		Total = np.sum(weights);
+
+		self.Scale = np.sum(P)/Total;
+		self.v_wind = np.average(wind_speeds, weights=weights);
+		self.WindSamples = (wind_speeds, wind_directions, weights);
+		self.P = self.StoreP(P, self.Scale, Total);
+
+		return self.P
+
 	def GetProb(self, x,y,z):
-		#check that x,y,z are in the grid
-		if not (0<=x<=self.size[0] and 0<=y<=self.size[1] and 0<=z<=self.size[2]):
+		#probability at the grid point closest to x,y,z
+		return self.GetProbs([[x,y,z]])[0]
+
+	def GetProbs(self, points, method = 'nearest', fill_value = None):
+		#probabilities at an (N,3) array of well pad coordinates, e.g. all the points of a candidate path
+		#method is 'nearest' (closest grid point) or 'linear' (trilinear interpolation between the 8 surrounding
+		#grid points); points outside the well pad region raise an exception unless a fill_value is given
+		points = np.asarray(points, dtype=float).reshape(-1,3);
+		size = np.asarray(self.size, dtype=float);
+		shape = np.asarray(self.P.shape);
+
+		#check that the points are in the grid
+		inside = np.all((points >= 0) & (points <= size), axis=1);
+		if fill_value is None and not np.all(inside):
 			raise Exception('Coordinates are not within the well pad region.')
 
-		#find the closest indices corresponding to x,y,z
-		i = floor(x/self.increments[0])
-		j = floor(y/self.increments[1])
-		k = floor(z/self.increments[2])
+		#position of every point in grid units, clamped to the last grid point
+		f = np.clip(points/np.asarray(self.increments, dtype=float), 0, shape - 1);
 
-		Prob = self.P[i,j,k]
+		if method == 'nearest':
+			i, j, k = np.floor(f + 0.5).astype(np.intp).T;
+			Prob = self.P[i,j,k];
+		elif method == 'linear':
+			lo = np.minimum(np.floor(f).astype(np.intp), np.maximum(shape - 2, 0));
+			hi = np.minimum(lo + 1, shape - 1);
+			t = f - lo;
+			Prob = np.zeros(len(points));
+			for corner in range(8):
+				bits = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1]);
+				idx = np.where(bits, hi, lo);
+				weight = np.prod(np.where(bits, t, 1 - t), axis=1);
+				Prob += weight*self.P[idx[:,0], idx[:,1], idx[:,2]];
+		else:
+			raise ValueError("method must be 'nearest' or 'linear'")
+
+		if fill_value is not None:
+			Prob = np.where(inside, Prob, fill_value);
 
 		return Prob
 
 	#for if/when we do the Bayesian inference update
-	# def DistUpdate(self,MethaneData):
\ No newline at end of file
+	# def DistUpdate(self,MethaneData):
+
+
+def LoadDistribution(P_file, mmap_mode = 'r'):
+	#opens a distribution written by ProbDist(..., P_file=...) without reading it into memory
+	#returns (P, Spacing, Shift) like DistributionSetUp.FindP_WellPad; the rest is in ReadMetadata(P_file)
+	P = np.load(P_file, mmap_mode=mmap_mode);
+	Metadata = ReadMetadata(P_file);
+
+	return P, Metadata['spacing'], Metadata['shift']
+
+def ReadMetadata(P_file):
+	with open(_MetadataFile(P_file)) as f:
+		return json.load(f)
+
+def _MetadataFile(P_file):
+	return os.path.splitext(P_file)[0] + '.json'
+
+def _LeakPositions(LeakPoints):
+	#(N,3) array of leak positions; accepts objects with a pos attribute or raw coordinates
+	return np.array([getattr(LP, 'pos', LP) for LP in LeakPoints], dtype=float).reshape(-1,3)
+
+def _PlumeField(dx, dy, zm, zp, wind_dir):
+	#Gaussian plume term at unit wind speed for a block of leaks and grid cells
+	#dx: (n_leaks, n_i), dy: (n_leaks, n_j), zm and zp: (n_leaks, n_k)
+	#only cells downwind of a leak see any gas, so the plume is returned for those cells alone:
+	#leak and cell indices (n, i, j) in C order, and an (n_cells, n_k) array of values
+	c = np.cos(wind_dir);
+	s = np.sin(wind_dir);
+
+	#convert to the coordinate system defined by Hodgkinson et al.
+	x = c*dx[:,:,None] + s*dy[:,None,:];
+	n, i, j = np.nonzero(x>(10**(-5)));
+	x = x[n,i,j];
+	y = -s*dx[n,i] + c*dy[n,j];
+
+	#find sigma_y and sigma_z based on the distance from the leak source (x), assuming neutral stability
+	sigma_y = 0.128*(x**0.9);
+	sigma_z = 0.093*(x**0.85);
+
+	horizontal = 1/(2*np.pi*sigma_y*sigma_z)*np.exp(-0.5*(y/sigma_y)**2);
+	sigma_z = sigma_z[:,None];
+	vertical = np.exp(-0.5*(zm[n]/sigma_z)**2) + np.exp(-0.5*(zp[n]/sigma_z)**2);
+
+	return n, i, j, horizontal[:,None]*vertical
+
+def _AccumulatePlume(P, offsets, wind_dir, chunk_size, truncate = None):
+	#adds the unit wind speed plume of every leak into P, a block of x rows at a time
+	if truncate is not None:
+		return _AccumulateTruncatedPlume(P, offsets, wind_dir, chunk_size, truncate)
+
+	dx, dy, zm, zp = offsets;
+	n_leaks = dx.shape[0];
+	plane = dy.shape[1]*zm.shape[1];
+	rows = max(1, min(dx.shape[1], chunk_size//plane));
+	leaks = max(1, chunk_size//(rows*plane));
+
+	for i0 in range(0, dx.shape[1], rows):
+		i1 = min(i0 + rows, dx.shape[1]);
+		block = np.zeros((i1 - i0,) + P.shape[1:]);
+		for n0 in range(0, n_leaks, leaks):
+			n1 = min(n0 + leaks, n_leaks);
+			n, i, j, field = _PlumeField(dx[n0:n1,i0:i1], dy[n0:n1], zm[n0:n1], zp[n0:n1], wind_dir);
+			#leaks are added one after the other so that the result does not depend on the chunking
+			bounds = np.searchsorted(n, np.arange(n1 - n0 + 1));
+			for m in range(n1 - n0):
+				cells = slice(bounds[m], bounds[m+1]);
+				block[i[cells], j[cells]] += field[cells];
+		P[i0:i1] += block;
+
+def _EnsemblePlume(P, offsets, n, wind_dirs, dir_weights, nodes, chunk_size):
+	#adds the plume of leak n for every wind direction, weighted by dir_weights, into P
+	#the vertical term is interpolated (linearly in log x) from profiles tabulated at the geometrically spaced downwind
+	#distances in nodes, so each direction only costs a pass over the horizontal plane and the volume is filled by one
+	#matrix product
+	dx, dy, zm, zp = offsets;
+	dx = dx[n];
+	dy = dy[n];
+	n_i, n_j, n_k = P.shape;
+	n_nodes = len(nodes);
+
+	sigma_z = 0.093*(nodes**0.85);
+	profiles = np.exp(-0.5*(zm[n]/sigma_z[:,None])**2) + np.exp(-0.5*(zp[n]/sigma_z[:,None])**2);
+	log_step = np.log(nodes[1]/nodes[0]);
+
+	c = np.cos(wind_dirs);
+	s = np.sin(wind_dirs);
+	rows = max(1, min(n_i, chunk_size//(n_j*max(n_nodes, len(wind_dirs)))));
+
+	for i0 in range(0, n_i, rows):
+		i1 = min(i0 + rows, n_i);
+		block = np.zeros((i1 - i0, n_j, n_k));
+		cells = block.reshape(-1, n_k);
+
+		x = c[:,None,None]*dx[None,i0:i1,None] + s[:,None,None]*dy[None,None,:];
+		d, i, j = np.nonzero(x>(10**(-5)));
+		x = x[d,i,j];
+		y = -s[d]*dx[i0+i] + c[d]*dy[j];
+		cell = i*n_j + j;
+
+		log_x = np.log(x);
+		sigma_y = 0.128*np.exp(0.9*log_x);
+		sigma_z = 0.093*np.exp(0.85*log_x);
+		horizontal = dir_weights[d]/(2*np.pi*sigma_y*sigma_z)*np.exp(-0.5*(y/sigma_y)**2);
+
+		near = x < nodes[0];
+		if np.any(near):
+			vertical = np.exp(-0.5*(zm[n]/sigma_z[near,None])**2) + np.exp(-0.5*(zp[n]/sigma_z[near,None])**2);
+			np.add.at(cells, cell[near], horizontal[near,None]*vertical);
+
+		far = ~near;
+		cell = cell[far];
+		horizontal = horizontal[far];
+		f = (log_x[far] - np.log(nodes[0]))/log_step;
+		b = np.minimum(f.astype(np.intp), n_nodes - 2);
+		f = f - b;
+
+		#weight of every (cell, tabulated profile) pair, summed over all directions
+		A = np.bincount(cell*n_nodes + b, weights=horizontal*(1 - f), minlength=len(cells)*n_nodes);
+		A += np.bincount(cell*n_nodes + b + 1, weights=horizontal*f, minlength=len(cells)*n_nodes);
+		cells += A.reshape(-1, n_nodes) @ profiles;
+
+		P[i0:i1] += block;
+
+def _AccumulatePlumeParallel(grid_size, offsets, wind_dir, chunk_size, truncate, workers):
+	#builds the unit wind speed field with a process pool; each task fills a slab of x rows directly in shared memory
+	#every cell is computed with the same operations, in the same leak order, whatever slab it falls in,
+	#so the result is bit-for-bit identical to the serial build for any number of workers
+	shm = shared_memory.SharedMemory(create=True, size=int(np.prod(grid_size))*8);
+	try:
+		Field = np.ndarray(grid_size, dtype=float, buffer=shm.buf);
+		Field[:] = 0.;
+		dx, dy, zm, zp = offsets;
+		slabs = np.array_split(np.arange(grid_size[0]), min(grid_size[0], 4*workers));
+		with ProcessPoolExecutor(max_workers=workers) as pool:
+			tasks = [pool.submit(_AccumulatePlumeSlab, shm.name, grid_size, slab[0], slab[-1] + 1,
+			                     (dx[:,slab[0]:slab[-1]+1], dy, zm, zp), wind_dir, chunk_size, truncate)
+			         for slab in slabs if len(slab)];
+			for task in tasks:
+				task.result();
+		Result = Field.copy();
+		del Field;
+	finally:
+		shm.close();
+		shm.unlink();
+
+	return Result
+
+def _AccumulatePlumeSlab(name, grid_size, i0, i1, offsets, wind_dir, chunk_size, truncate):
+	#process pool task: adds the plume into rows i0:i1 of the shared field
+	shm = shared_memory.SharedMemory(name=name);
+	try:
+		Field = np.ndarray(grid_size, dtype=float, buffer=shm.buf);
+		_AccumulatePlume(Field[i0:i1], offsets, wind_dir, chunk_size, truncate);
+		del Field;
+	finally:
+		shm.close();
+
+def _AccumulateTruncatedPlume(P, offsets, wind_dir, chunk_size, truncate):
+	#like _AccumulatePlume, but each leak only visits the cells of its downwind cone with |y| <= truncate*sigma_y,
+	#and only the heights with |z - H| <= truncate*sigma_z (the ground reflection is always inside that band since
+	#z + H >= |z - H|). Cells are grouped by their height band so every group is filled with one array operation.
+	dx, dy, zm, zp = offsets;
+	n_leaks = dx.shape[0];
+	rows = max(1, min(dx.shape[1], chunk_size//(dy.shape[1]*zm.shape[1])));
+	c = np.cos(wind_dir);
+	s = np.sin(wind_dir);
+
+	for i0 in range(0, dx.shape[1], rows):
+		i1 = min(i0 + rows, dx.shape[1]);
+		block = np.zeros((i1 - i0,) + P.shape[1:]);
+		for n in range(n_leaks):
+			x = c*dx[n,i0:i1,None] + s*dy[n,None,:];
+			i, j = np.nonzero(x>(10**(-5)));
+			x = x[i,j];
+			y = -s*dx[n,i0+i] + c*dy[n,j];
+
+			sigma_y = 0.128*(x**0.9);
+			cone = np.abs(y) <= truncate*sigma_y;
+			i, j, x, y, sigma_y = i[cone], j[cone], x[cone], y[cone], sigma_y[cone];
+			sigma_z = 0.093*(x**0.85);
+			horizontal = 1/(2*np.pi*sigma_y*sigma_z)*np.exp(-0.5*(y/sigma_y)**2);
+
+			#height band of every cell, [k_lo, k_hi)
+			k_lo = np.searchsorted(zm[n], -truncate*sigma_z, 'left');
+			k_hi = np.searchsorted(zm[n], truncate*sigma_z, 'right');
+			band = k_lo*(zm.shape[1] + 1) + k_hi;
+			order = np.argsort(band, kind='stable');
+			bands, first = np.unique(band[order], return_index=True);
+			first = np.append(first, len(order));
+
+			for g in range(len(bands)):
+				cells = order[first[g]:first[g+1]];
+				lo, hi = k_lo[cells[0]], k_hi[cells[0]];
+				if lo == hi:
+					continue
+				sz = sigma_z[cells,None];
+				vertical = np.exp(-0.5*(zm[n,lo:hi]/sz)**2) + np.exp(-0.5*(zp[n,lo:hi]/sz)**2);
+				block[i[cells], j[cells], lo:hi] += horizontal[cells,None]*vertical;
+		P[i0:i1] += block;
@@ -0,0 +1,185 @@
+import time
+import numpy as np
+from ProbDist import ProbDist
+from initialwaypoint import initwaypoint
+from scipy.spatial.distance import pdist, squareform
+from tsp_solver.greedy import solve_tsp, local_searches
+from tsp_solver.util import path_cost
+from tsp_solver.parallel import solve_tsp_multistart
+from PathGeneration import Object, Obstacles
+
+"""
+Benchmarks
+times the vectorized parts of the planning pipeline against the original implementations
+run with: python benchmark.py
+"""
+
+class Leak:
+	#stand-in for flightdata.WellpadComponent, which needs the kml/csv dependencies
+	def __init__(self, pos):
+		self.pos = np.array(pos, dtype=float)
+
+def RandomLeaks(n_leaks, size, seed=0):
+	rng = np.random.default_rng(seed)
+	return [Leak([rng.uniform(0.25, 0.75)*size[0], rng.uniform(0.25, 0.75)*size[1], 3.]) for i in range(n_leaks)]
+
+def BenchDistribution(grid_size=(60,60,10), size=(100.,100.,10.), n_leaks=5, wind_speed=2., wind_dir=30.):
+	#vectorized ComputeDistribution vs the original cell by cell loop
+	leaks = RandomLeaks(n_leaks, size)
+
+	start = time.perf_counter()
+	Dist = ProbDist(size, grid_size, leaks, wind_speed, wind_dir)
+	t_vec = time.perf_counter() - start
+
+	start = time.perf_counter()
+	P_loop = Dist.ComputeDistributionLoop()
+	t_loop = time.perf_counter() - start
+
+	print('ComputeDistribution, grid {}, {} leaks'.format(grid_size, n_leaks))
+	print('  loop:       {:.3f} s'.format(t_loop))
+	print('  vectorized: {:.3f} s ({:.0f}x)'.format(t_vec, t_loop/t_vec))
+	print('  max |P_loop - P_vec| = {:.3e}'.format(np.max(np.abs(P_loop - Dist.P))))
+
+def BenchEnsemble(grid_size=(200,200,20), size=(100.,100.,10.), n_leaks=5, n_samples=100):
+	#wind ensemble with shared vertical profiles vs one ComputeDistribution per sample
+	leaks = RandomLeaks(n_leaks, size)
+	rng = np.random.default_rng(1)
+	speeds = rng.uniform(1., 4., n_samples)
+	directions = rng.normal(45., 15., n_samples)
+	Dist = ProbDist(size, grid_size, leaks, speeds[0], directions[0], field_cache=0)
+
+	start = time.perf_counter()
+	P_exact = Dist.EnsembleUpdate(speeds, directions, n_profiles=0).copy()
+	t_exact = time.perf_counter() - start
+
+	start = time.perf_counter()
+	P_table = Dist.EnsembleUpdate(speeds, directions)
+	t_table = time.perf_counter() - start
+
+	print('EnsembleUpdate, grid {}, {} leaks, {} wind samples'.format(grid_size, n_leaks, n_samples))
+	print('  one field per sample: {:.3f} s'.format(t_exact))
+	print('  shared profiles:      {:.3f} s ({:.1f}x)'.format(t_table, t_exact/t_table))
+	print('  max |P_exact - P_table| / max P = {:.3e}'.format(np.max(np.abs(P_exact - P_table))/np.max(P_exact)))
+
+def BenchTruncation(grid_size=(400,400,40), size=(100.,100.,10.), n_leaks=10, truncate=4.):
+	#plume evaluated on its truncated support vs the full grid
+	leaks = RandomLeaks(n_leaks, size)
+
+	start = time.perf_counter()
+	Full = ProbDist(size, grid_size, leaks, 2., 45.)
+	t_full = time.perf_counter() - start
+
+	start = time.perf_counter()
+	Truncated = ProbDist(size, grid_size, leaks, 2., 45., truncate=truncate)
+	t_trunc = time.perf_counter() - start
+
+	print('Truncated support ({} sigma), grid {}, {} leaks'.format(truncate, grid_size, n_leaks))
+	print('  full grid: {:.3f} s'.format(t_full))
+	print('  truncated: {:.3f} s ({:.1f}x)'.format(t_trunc, t_full/t_trunc))
+	print('  reported truncation error {:.3e}, sum |P_full - P_trunc| = {:.3e}'.format(Truncated.TruncationError, np.sum(np.abs(Full.P - Truncated.P))))
+
+def BenchWorkers(grid_size=(400,400,40), size=(100.,100.,10.), n_leaks=20, workers=(1,2,4,8)):
+	#process pool build for several worker counts; the fields must be identical
+	leaks = RandomLeaks(n_leaks, size)
+	print('Process pool build, grid {}, {} leaks'.format(grid_size, n_leaks))
+	P_ref = None
+	for w in workers:
+		start = time.perf_counter()
+		Dist = ProbDist(size, grid_size, leaks, 2., 45., workers=w)
+		elapsed = time.perf_counter() - start
+		if P_ref is None:
+			P_ref = Dist.P
+		print('  {} workers: {:.3f} s, identical: {}'.format(w, elapsed, np.array_equal(P_ref, Dist.P)))
+
+def BenchWaypoints(grid_size=(200,200,20), size=(100.,100.,10.), n_leaks=10, power=10):
+	#local maximum search of initwaypoint on a full size grid, with the window of main.py
+	leaks = RandomLeaks(n_leaks, size)
+	Dist = ProbDist(size, grid_size, leaks, 2., 45.)
+	Spacing = Dist.increments
+
+	start = time.perf_counter()
+	WayPoints = initwaypoint(Dist.P, Spacing[0], Spacing[1], Spacing[2], power=power)
+	elapsed = time.perf_counter() - start
+
+	start = time.perf_counter()
+	Streamed = initwaypoint(Dist.P, Spacing[0], Spacing[1], Spacing[2], power=power, slab=32)
+	t_slab = time.perf_counter() - start
+
+	print('initwaypoint, grid {}, power {}'.format(grid_size, power))
+	print('  {} waypoints in {:.3f} s'.format(len(WayPoints), elapsed))
+	print('  32 row slabs: {:.3f} s, identical: {}'.format(t_slab, np.array_equal(WayPoints, Streamed)))
+
+def BenchObstacles(n_points=400, n_tanks=200, n_prisms=40, size=100., seed=0):
+	#detour costs of every pair of waypoints with the spatial index vs every segment against every obstacle;
+	#the prisms include one whose buffered bounds come out inverted on an axis, which both must treat as empty
+	rng = np.random.default_rng(seed)
+	corners = rng.uniform(0, size, (n_prisms, 2))
+	equipment = [Object(rng.uniform(0.1, 1.5), 'tank', rng.uniform(0, size, 2)) for i in range(n_tanks)]
+	equipment += [Object([c, c + rng.uniform(1, 6, 2)], 'prism', c) for c in corners]
+	equipment.append(Object([[-0.4,-5.4],[1.2,-3.5]], 'prism', [0.4,-4.45]))
+	obstacles = Obstacles(equipment)
+	points = np.vstack([rng.uniform(-10, size, (n_points, 2)), [[-10,-4],[10,-4]]])
+	i, j = np.tril_indices(len(points), -1)
+
+	start = time.perf_counter()
+	brute = obstacles.Costs(points[i], points[j], use_index=False, chords=True)
+	t_brute = time.perf_counter() - start
+
+	start = time.perf_counter()
+	indexed = obstacles.Costs(points[i], points[j], chords=True)
+	t_index = time.perf_counter() - start
+
+	print('Obstacles.Costs, {} pairs, {} obstacles'.format(len(i), len(equipment)))
+	print('  all obstacles: {:.3f} s'.format(t_brute))
+	print('  grid index:    {:.3f} s ({:.1f}x), {culled} of {total} tests culled'.format(t_index, t_brute/t_index,
+	      total=obstacles.stats['tests'] + obstacles.stats['culled'], **obstacles.stats))
+	print('  identical: {}'.format(all(np.allclose(a, b) for a, b in zip(brute, indexed))))
+
+def LoadWaypoints(filename):
+	#waypoint files are written either by np.savetxt or as printed arrays ("[x y z]" per line);
+	#lines without three coordinates (e.g. partly overwritten ones) are skipped
+	with open(filename) as f:
+		rows = [line.replace('[', ' ').replace(']', ' ').split() for line in f]
+	return np.array([[float(v) for v in row] for row in rows if len(row) == 3])
+
+def WaypointSets(seed=2):
+	rng = np.random.default_rng(seed)
+	clusters = rng.uniform(0, 100, (10, 2))
+	return [('waypoints.txt', LoadWaypoints('waypoints.txt')),
+	        ('waypoints2.txt', LoadWaypoints('waypoints2.txt')),
+	        ('uniform 200', rng.uniform(0, 100, (200, 2))),
+	        ('clustered 500', clusters[rng.integers(0, 10, 500)] + rng.normal(0, 4, (500, 2))),
+	        ('uniform 1000', rng.uniform(0, 100, (1000, 2)))]
+
+def BenchTSP():
+	#tour length against runtime of each local search of solve_tsp, run until no move improves the path
+	print('solve_tsp local searches (path length, time)')
+	for name, points in WaypointSets():
+		distances = squareform(pdist(points[:, 0:2])).tolist()
+		results = []
+		for search in [None] + sorted(local_searches):
+			start = time.perf_counter()
+			path = solve_tsp(distances, optim_steps=0 if search is None else None, local_search=search or '2opt')
+			elapsed = time.perf_counter() - start
+			results.append('{} {:.1f} ({:.3f} s)'.format(search or 'greedy', path_cost(distances, path), elapsed))
+		print('  {} ({} points): {}'.format(name, len(points), ', '.join(results)))
+
+def BenchMultistart(n_points=500, starts=(1, 4, 16), workers=None, seed=0):
+	#shortest path of several perturbed greedy starts, each followed by or3opt, on a process pool
+	points = np.random.default_rng(seed).uniform(0, 100, (n_points, 2))
+	distances = squareform(pdist(points))
+	print('solve_tsp_multistart, {} uniform points'.format(n_points))
+	for n in starts:
+		start = time.perf_counter()
+		path, info = solve_tsp_multistart(distances, starts=n, workers=workers, seed=seed, return_info=True)
+		print('  {} starts: length {:.1f} in {:.3f} s'.format(n, info['cost'], time.perf_counter() - start))
+
+if __name__ == '__main__':
+	BenchDistribution()
+	BenchEnsemble()
+	BenchTruncation()
+	BenchWorkers()
+	BenchWaypoints()
+	BenchObstacles()
+	BenchTSP()
+	BenchMultistart()
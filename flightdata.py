@@ -25,6 +25,12 @@ class FlightData:
             component, self.origin = placemark_to_component(placemark, self.origin)
             self.wellpad_components = np.append(self.wellpad_components, component)
 
+        # all component positions as one (N,3) array; each component's pos is a view of its row,
+        # so vectorized updates of component_positions are seen through the components
+        self.component_positions = np.array([c.pos for c in self.wellpad_components], dtype=float).reshape(-1, 3)
+        for component, pos in zip(self.wellpad_components, self.component_positions):
+            component.pos = pos
+
     def test_func(self):
         print('hello')
 
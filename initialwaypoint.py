@@ -1,66 +1,177 @@
-import numpy as n
-
-"""
-Initial Waypoint Creation
-finds the local maxima of the probability array using the argrelmax function of scipy and returns a 2D array of the coordinates of the waypoints
-inputs:     prob    -   probability array of the well-pad (3D numpy array of any size)
-           xspacing -   spacing in the x direction
-           yspacing -   spacing in the y direction
-           zspacing -   spacing in the z direction
-            power   -   the radius / window size of comparison for the argrelmax check, with a default value of 1 (must be an int)
-outputs:    wps     -   array containing the coordinates of the waypoints 
-"""
-
-def initwaypoint(prob, xspacing, yspacing, zspacing, power=1):
-
-    # ----------------------
-    # Variable Instantiation
-    # ----------------------
-
-    first = True                                                                                        # boolean value of whether this is the first entry in the waypoints array
-    comp = n.empty([n.shape(prob)[0], n.shape(prob)[1], n.shape(prob)[2]], dtype = bool)                # preallocate the comparison array
-    # fill the comp array
-    for i in range(0,n.shape(prob)[0]):                     
-        for j in range(0,n.shape(prob)[1]):
-            for k in range(0,n.shape(prob)[2]):
-                comp[i,j,k] = True
-    wps = n.zeros([1,3])                                                                              # instantiate the wps array
-
-    # ------
-    # Engine
-    # ------
-
-    # perform the comparisons for each power level
-    for i in range(0,n.shape(prob)[0]):                     # loop over the points
-        for j in range(0,n.shape(prob)[1]):
-            for k in range(0,n.shape(prob)[2]):
-                for x in range(-1*power, power + 1):        # loop over the window
-                    if not(comp[i,j,k]):
-                                break
-                    compx = i + x
-                    if (compx >= 0) and (compx < n.shape(prob)[0]):
-                        for y in range(-1*power, power + 1):
-                            if not(comp[i,j,k]):
-                                break
-                            compy = j + y
-                            if (compy >= 0) and (compy < n.shape(prob)[1]):
-                                for z in range(-1*power, power + 1):
-                                    if not(comp[i,j,k]):
-                                        break
-                                    compz = k + z
-                                    if (compz >= 0) and (compz < n.shape(prob)[2]):
-                                        if not(compx == i and compy == j and compz == k):
-                                            comp[i,j,k] = comp[i,j,k] & (prob[i,j,k] > prob[compx, compy, compz])
-
-    # find the coordinates of the maxima based on the indices of the comparison array
-    for i in range(0,n.shape(prob)[0]):                             # loop over the coordinate indices
-        for j in range(0, n.shape(prob)[1]):
-            for k in range(0, n.shape(prob)[2]):
-                if comp[i,j,k]:
-                    if first:
-                        first = False
-                        wps = n.array([[i*xspacing, j*yspacing, k*zspacing]])
-                    else:
-                        wps = n.append(wps, [[i*xspacing, j*yspacing, k*zspacing]], axis=0)     
-
-    return wps
+import numpy as n
+import heapq
+from scipy.ndimage import maximum_filter1d
+
+"""
+Initial Waypoint Creation
+finds the strict local maxima of the probability array and returns a 2D array of the coordinates of the waypoints
+a point is a maximum if it is greater than every other point of the (2*power+1)^3 window centered on it, with the window
+clipped at the borders of the array; ties are not maxima
+inputs:     prob    -   probability array of the well-pad (3D numpy array of any size), or the name of a .npy file of it,
+                        which is memory-mapped
+           xspacing -   spacing in the x direction
+           yspacing -   spacing in the y direction
+           zspacing -   spacing in the z direction
+            power   -   the radius / window size of comparison for the local maximum check, with a default value of 1 (must be an int)
+          min_prob  -   optional probability floor; maxima below it are dropped
+          max_count -   optional maximum number of waypoints; the most probable maxima are kept
+       min_separation - optional minimum distance between waypoints, in meters; maxima closer than this to a more
+                        probable kept maximum are dropped
+        return_prob -   if True, the probabilities of the waypoints are returned as well
+        as_records  -   if True, wps is a structured array of waypoint_dtype (coordinates, grid indices and probability)
+            slab    -   optional number of x rows read at a time; the array is then streamed in slabs with a halo of power
+                        rows on each side, so memory grows with the slab size and not the grid size (same result as None)
+outputs:    wps     -   (M,3) array containing the coordinates of the waypoints, in grid order; (0,3) if there are none
+            probs   -   probabilities of the waypoints (only if return_prob is True)
+"""
+
+waypoint_dtype = n.dtype([('x', float), ('y', float), ('z', float), ('i', n.intp), ('j', n.intp), ('k', n.intp), ('prob', float)])
+
+def initwaypoint(prob, xspacing, yspacing, zspacing, power=1, min_prob=None, max_count=None, min_separation=None, return_prob=False, as_records=False, slab=None):
+
+    # ------
+    # Engine
+    # ------
+
+    if isinstance(prob, str):
+        prob = n.load(prob, mmap_mode='r')
+    if slab is None:
+        maxima, probs = findmaxima(prob, power)
+    else:
+        maxima, probs = findmaxima_slabs(prob, power, slab)
+
+    # ---------
+    # Selection
+    # ---------
+
+    if min_prob is not None:
+        keep = probs >= min_prob
+        maxima, probs = maxima[keep], probs[keep]
+    if max_count is not None or min_separation is not None:
+        keep = selectmaxima(maxima*[xspacing, yspacing, zspacing], probs, max_count, min_separation)
+        maxima, probs = maxima[keep], probs[keep]
+
+    # find the coordinates of the maxima based on the indices of the comparison array
+    records = n.empty(len(maxima), dtype=waypoint_dtype)
+    records['i'], records['j'], records['k'] = maxima.T
+    records['x'] = records['i']*xspacing
+    records['y'] = records['j']*yspacing
+    records['z'] = records['k']*zspacing
+    records['prob'] = probs
+
+    if as_records:
+        wps = records
+    else:
+        wps = n.stack([records['x'], records['y'], records['z']], axis=1)
+
+    if return_prob:
+        return wps, probs
+    return wps
+
+"""
+Maxima Search
+grid indices and probabilities of the strict local maxima of prob, in grid order
+findmaxima_slabs reads prob (e.g. a memory-mapped array) slab rows at a time along x: each slab is extended by a halo of
+power rows on both sides, which is all the window of its points can reach, and only the maxima of its own rows are kept
+at the borders of the array there is no halo, so the window is clipped exactly as it is on the whole array
+"""
+
+def findmaxima(prob, power=1):
+    comp = localmaxima(prob, power)
+    return n.argwhere(comp), n.asarray(prob)[comp]
+
+def findmaxima_slabs(prob, power=1, slab=64):
+    if slab < 1:
+        raise ValueError('slab must be at least 1')
+    halo = int(power)
+    indices, probs = [], []
+    for start in range(0, prob.shape[0], slab):
+        stop = min(start + slab, prob.shape[0])
+        lo = max(start - halo, 0)
+        hi = min(stop + halo, prob.shape[0])
+        block = n.asarray(prob[lo:hi])                                  # only the slab and its halo are read
+        comp = localmaxima(block, power)[start - lo:stop - lo]
+        found = n.argwhere(comp)
+        probs.append(block[start - lo:stop - lo][comp])
+        found[:, 0] += start
+        indices.append(found)
+
+    if not indices:
+        return n.empty((0, prob.ndim), dtype=n.intp), n.empty(0, dtype=prob.dtype)
+    return n.concatenate(indices), n.concatenate(probs)
+
+"""
+Maxima Selection
+indices (sorted, so grid order is kept) of the maxima to keep, taken in decreasing order of probability: at most max_count
+of them, each at least min_separation meters from the ones already kept
+only the maxima are ordered, through a heap, so the cost does not depend on the size of the grid
+"""
+
+def selectmaxima(positions, probs, max_count=None, min_separation=None):
+    count = len(probs) if max_count is None else min(max_count, len(probs))
+    order = [(-p, index) for index, p in enumerate(probs)]             # ties are broken by grid order
+    if min_separation is None:
+        return n.sort(n.array([index for p, index in heapq.nsmallest(count, order)], dtype=n.intp))
+
+    heapq.heapify(order)
+    kept = []
+    while order and len(kept) < count:
+        p, index = heapq.heappop(order)
+        if kept and n.min(n.linalg.norm(positions[kept] - positions[index], axis=1)) < min_separation:
+            continue
+        kept.append(index)
+    return n.sort(n.array(kept, dtype=n.intp))
+
+"""
+Local Maxima
+boolean array of the strict local maxima of prob within the (2*power+1)^3 window, clipped at the borders
+the window maximum excluding the center point is built from separable 1D maximum filters, splitting the window into
+    {dx != 0} x [-p,p] x [-p,p]  U  {dx = 0} x {dy != 0} x [-p,p]  U  {dx = 0} x {dy = 0} x {dz != 0}
+so every point costs a few comparisons per axis instead of (2*power+1)^3
+"""
+
+def localmaxima(prob, power=1):
+    prob = n.asarray(prob)
+    if power == 0 or prob.size <= 1:
+        return n.ones(prob.shape, dtype=bool)                           # no other point to compare against
+    if not n.issubdtype(prob.dtype, n.floating):
+        prob = prob.astype(float)                                       # -inf is used outside the array
+
+    excluded = n.full(prob.shape, -n.inf, dtype=prob.dtype)             # maximum over the window without its center
+    partial = _windowmax(prob, 0, power, center=False)                  # {dx != 0} x [-p,p] x [-p,p]
+    partial = _windowmax(partial, 1, power)
+    n.maximum(excluded, _windowmax(partial, 2, power), out=excluded)
+    partial = _windowmax(prob, 1, power, center=False)                  # {dx = 0} x {dy != 0} x [-p,p]
+    n.maximum(excluded, _windowmax(partial, 2, power), out=excluded)
+    n.maximum(excluded, _windowmax(prob, 2, power, center=False), out=excluded)     # {dx = 0} x {dy = 0} x {dz != 0}
+
+    comp = prob > excluded
+
+    # a comparison with nan is false, so points that are nan or see a nan in their window are never maxima
+    nans = n.isnan(prob)
+    if n.any(nans):
+        for axis in range(3):
+            nans = maximum_filter1d(nans, 2*power + 1, axis=axis, mode='constant', cval=False)
+        comp &= ~nans
+
+    return comp
+
+def _windowmax(a, axis, power, center=True):
+    # maximum along axis over offsets [-power, power], or [-power, -1] U [1, power] if center is False
+    # points outside the array count as -inf, so the window is clipped at the borders
+    if power == 0:
+        return a if center else n.full(a.shape, -n.inf, dtype=a.dtype)
+    if center:
+        return maximum_filter1d(a, 2*power + 1, axis=axis, mode='constant', cval=-n.inf)
+
+    # both one-sided windows have size power; pad so they can be read off the same filtered array
+    size = a.shape[axis]
+    pad = [(0, 0)]*a.ndim
+    pad[axis] = (power, power)
+    filtered = maximum_filter1d(n.pad(a, pad, constant_values=-n.inf), power, axis=axis, mode='constant', cval=-n.inf)
+    # the filtered value at padded index c covers padded[c - power//2 : c - power//2 + power]
+    below = [slice(None)]*a.ndim
+    above = [slice(None)]*a.ndim
+    below[axis] = slice(power//2, power//2 + size)                              # offsets [-power, -1]
+    above[axis] = slice(power + 1 + power//2, power + 1 + power//2 + size)      # offsets [1, power]
+    return n.maximum(filtered[tuple(below)], filtered[tuple(above)])
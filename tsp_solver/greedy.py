@@ -1,6 +1,9 @@
 from __future__ import print_function, division
 from itertools import islice
 from array import array as pyarray
+import time
+import numpy
+from tsp_solver.util import path_cost
 ################################################################################
 # A simple algorithm for solving the Travelling Salesman Problem
 # Finds a suboptimal solution
@@ -11,43 +14,233 @@ if "xrange" not in globals():
 else:
     #py2
     pass
+
+#wall clock used for time budgets
+_clock = getattr(time, "perf_counter", time.time)
     
 
-def optimize_solution( distances, connections, endpoints ):
-    """Tries to optimize solution, found by the greedy algorithm"""
-    N = len(connections)
-    path = restore_path( connections, endpoints )
-    def ds(i,j): #distance between ith and jth points of path
-        pi = path[i]
-        pj = path[j]
-        if pi < pj:
-            return distances[pj][pi]
+def square_matrix( distances ):
+    """Returns the square symmetric float64 numpy matrix of a left-triangular distance matrix,
+    so that the distance between i and j is rows[i, j] whatever their order"""
+    N = len(distances)
+    if isinstance(distances, numpy.ndarray) and distances.ndim == 2:
+        rows = numpy.tril(distances[:N, :N], -1).astype(numpy.float64, copy=False)
+    else:
+        rows = numpy.zeros((N, N))
+        for i in xrange(1, N):
+            rows[i, :i] = distances[i][:i]
+    #mirror the left triangle by blocks of rows, without a second full-size temporary
+    for lo in xrange(0, N, 256):
+        hi = min(lo + 256, N)
+        block = rows[lo:hi, lo:hi]
+        block += block.T
+        rows[lo:hi, hi:] = rows[hi:, lo:hi].T
+    return rows
+
+def nearest_neighbors( rows, neighbors=16, deadline=None ):
+    """For each node, list of pairs (node, distance) of its nearest `neighbors` nodes, closest first.
+    rows is a square numpy matrix (see square_matrix); it is processed by blocks of rows,
+    so that only a block of argpartition indices is in memory at a time.
+    Returns None if the clock reaches deadline before the end."""
+    N = len(rows)
+    k = min(neighbors, N - 1)
+    if k <= 0: return [ [] for i in xrange(N) ]
+    near = []
+    for lo in xrange(0, N, 256):
+        if deadline is not None and _clock() >= deadline: return None
+        block = rows[lo:lo + 256]
+        #the k+1 smallest distances of each row: the node itself and its k nearest neighbors
+        idx = numpy.argpartition(block, k, axis=1)[:, :k + 1]
+        dist = numpy.take_along_axis(block, idx, axis=1)
+        order = numpy.argsort(dist, axis=1, kind="stable")
+        idx = numpy.take_along_axis(idx, order, axis=1).tolist()
+        dist = numpy.take_along_axis(dist, order, axis=1).tolist()
+        for r, (nodes, ds) in enumerate(zip(idx, dist)):
+            node = lo + r
+            near.append([ (j, d) for j, d in zip(nodes, ds) if j != node ][:k])
+    return near
+
+def _positions( path ):
+    pos = [0]*len(path)
+    for i, node in enumerate(path):
+        pos[node] = i
+    return pos
+
+def _reverse( path, pos, lo, hi ):
+    """Reverse path[lo..hi] in place"""
+    while lo < hi:
+        u, v = path[lo], path[hi]
+        path[lo], path[hi] = v, u
+        pos[v], pos[u] = lo, hi
+        lo += 1
+        hi -= 1
+
+def _run_rounds( path, improve, max_rounds, deadline=None ):
+    """Calls improve(node) on every node, then again on the nodes touched by improving moves,
+    until no move is found, max_rounds rounds are done (don't-look bits) or the clock reaches deadline.
+    improve returns None or a pair (gain, touched nodes).
+    Returns number of moves, total gain and the reason of the stop:
+    "local optimum", "optim_steps" or "time_budget" """
+    moves = 0
+    gain = 0.0
+    rounds = 0
+    current = list(path)
+    queued = bytearray([1])*len(path)
+    while current:
+        if max_rounds is not None and rounds >= max_rounds:
+            return moves, gain, "optim_steps"
+        rounds += 1
+        upcoming = []
+        for a in current:
+            if deadline is not None and _clock() >= deadline:
+                return moves, gain, "time_budget"
+            queued[a] = 0
+            result = improve(a)
+            if result is None: continue
+            delta, touched = result
+            moves += 1
+            gain += delta
+            for node in touched:
+                if not queued[node]:
+                    queued[node] = 1
+                    upcoming.append(node)
+        current = upcoming
+    return moves, gain, "local optimum"
+
+def two_opt( path, rows, neighbors=16, max_rounds=None, near=None, deadline=None ):
+    """2-opt local search on an open path, whose first and last nodes stay in place.
+    The path is modified in place and the position of every node is kept in an array,
+    so a move costs only the reversal of the segment between its two edges.
+    Only moves that bring a node next to one of its nearest neighbors are tried, and a node is
+    looked at again only if one of its edges changed (don't-look bits).
+
+    :arg: path : list of vertex indices, modified in place
+    :arg: rows : square symmetric numpy distance matrix, see square_matrix
+    :arg: neighbors (int) : number of nearest neighbors tried for each node
+    :arg: max_rounds (int) : None or maximal number of rounds; the first round looks at every node,
+          the next ones only at the nodes touched by the previous round
+    :arg: near : None or precomputed nearest_neighbors(rows, neighbors)
+    :arg: deadline : None or value of the clock (time.perf_counter) at which to stop
+    Returns number of moves, total gain and the reason of the stop (see _run_rounds)
+    """
+    N = len(path)
+    if N < 4: return 0, 0.0, "local optimum"
+    pos = _positions(path)
+    if near is None:
+        near = nearest_neighbors(rows, neighbors)
+    dist = rows.item
+
+    def improve(a):
+        #apply the first improving move that adds an edge from a to one of its neighbors
+        #and returns (gain, touched nodes), or None
+        i = pos[a]
+        for step in (1, -1):
+            k = i + step
+            if k < 0 or k >= N: continue
+            b = path[k]
+            d_ab = dist(a, b)
+            for c, d_ac in near[a]:
+                g = d_ab - d_ac
+                if g <= 0: break #neighbors are sorted, no further gain possible
+                j = pos[c]
+                l = j + step
+                if l < 0 or l >= N: continue
+                d = path[l]
+                if d == a: continue
+                delta = g + dist(d, c) - dist(d, b)
+                if delta > 1e-12:
+                    #replace edges (a,b), (c,d) by (a,c), (b,d)
+                    if step == 1:
+                        if i < j: _reverse(path, pos, i+1, j)
+                        else: _reverse(path, pos, j+1, i)
+                    else:
+                        if i < j: _reverse(path, pos, i, j-1)
+                        else: _reverse(path, pos, j, i-1)
+                    return delta, (a, b, c, d)
+        return None
+
+    return _run_rounds(path, improve, max_rounds, deadline)
+
+def or_opt( path, rows, neighbors=16, max_rounds=None, near=None, deadline=None, max_segment=3 ):
+    """Or-opt local search on an open path, whose first and last nodes stay in place:
+    moves segments of 1 to `max_segment` consecutive nodes, in either direction, between two other
+    consecutive nodes. Only insertions next to one of the nearest neighbors of an end of the segment
+    are tried, with the same don't-look bits as two_opt.
+    Arguments and return value are the same as for two_opt.
+    """
+    N = len(path)
+    if N < 4: return 0, 0.0, "local optimum"
+    pos = _positions(path)
+    if near is None:
+        near = nearest_neighbors(rows, neighbors)
+    dist = rows.item
+
+    def move(start, end, lo, first):
+        #move path[start..end] between path[lo] and path[lo+1], with node `first` next to path[lo]
+        if lo > end:
+            #segment goes forward: A B -> B A
+            _reverse(path, pos, start, lo)
+            _reverse(path, pos, start, lo - (end - start) - 1)
+            seg_lo, seg_hi = lo - (end - start), lo
         else:
-            return distances[pi][pj]
-            
-    d_total = 0.0
-    optimizations = 0
-    for a in xrange(N-1):
-        b = a+1
-        for c in xrange( b+2, N-1):
-            d = c+1
-            delta_d = ds(a,b)+ds(c,d) -( ds(a,c)+ds(b,d))
-            if delta_d > 0:
-                d_total += delta_d
-                optimizations += 1
-                connections[path[a]].remove(path[b])
-                connections[path[a]].append(path[c])
-                connections[path[b]].remove(path[a])
-                connections[path[b]].append(path[d])
-
-                connections[path[c]].remove(path[d])
-                connections[path[c]].append(path[a])
-                connections[path[d]].remove(path[c])
-                connections[path[d]].append(path[b])
-                path[:] = restore_path( connections, endpoints )
-    
-    return optimizations, d_total
-        
+            #segment goes backward: B A -> A B
+            _reverse(path, pos, lo + 1, end)
+            _reverse(path, pos, lo + 1 + (end - start) + 1, end)
+            seg_lo, seg_hi = lo + 1, lo + 1 + (end - start)
+        if path[seg_lo] != first:
+            _reverse(path, pos, seg_lo, seg_hi)
+
+    def improve(a):
+        #apply the first improving move of a segment that starts or ends with a
+        i = pos[a]
+        for length in xrange(1, max_segment + 1):
+            for start in (i, i - length + 1):
+                end = start + length - 1
+                if start < 1 or end > N - 2: continue
+                s0, s1 = path[start], path[end]
+                p, n = path[start - 1], path[end + 1]
+                #gain of taking the segment out
+                g = dist(p, s0) + dist(s1, n) - dist(p, n)
+                if g <= 1e-12: continue
+                for x, y in ((s0, s1), (s1, s0)):
+                    for e, d_ex in near[x]:
+                        if d_ex >= g: break #neighbors are sorted, no further gain possible
+                        k = pos[e]
+                        if start <= k <= end: continue
+                        for kf in (k - 1, k + 1):
+                            if kf < 0 or kf >= N or start <= kf <= end: continue
+                            f = path[kf]
+                            if (e, f) == (p, n) or (e, f) == (n, p): continue
+                            delta = g + dist(e, f) - d_ex - dist(y, f)
+                            if delta > 1e-12:
+                                #x goes next to e, y next to f
+                                lo = min(k, kf)
+                                move(start, end, lo, x if k == lo else y)
+                                return delta, (p, n, s0, s1, e, f)
+        return None
+
+    return _run_rounds(path, improve, max_rounds, deadline)
+
+def or_3opt( path, rows, neighbors=16, max_rounds=None, near=None, deadline=None ):
+    """Alternates two_opt and or_opt until neither improves the path. Or-opt moves are the
+    segment insertion moves of 3-opt, so the result is locally optimal for 2-opt and for
+    those 3-opt moves. Arguments and return value are the same as for two_opt."""
+    if near is None:
+        near = nearest_neighbors(rows, neighbors)
+    moves, gain, stop = two_opt(path, rows, max_rounds=max_rounds, near=near, deadline=deadline)
+    while stop != "time_budget":
+        m, g, stop = or_opt(path, rows, max_rounds=max_rounds, near=near, deadline=deadline)
+        moves += m
+        gain += g
+        if m == 0 or stop == "time_budget": break
+        m, g, stop = two_opt(path, rows, max_rounds=max_rounds, near=near, deadline=deadline)
+        moves += m
+        gain += g
+    return moves, gain, stop
+
+#local search procedures selectable in solve_tsp
+local_searches = { "2opt": two_opt, "oropt": or_opt, "or3opt": or_3opt }
+
 def restore_path( connections, endpoints ):
     """Takes array of connections and returns a path.
     Connections is array of lists with 1 or 2 elements.
@@ -92,19 +285,45 @@ def pairs_by_dist(N, distances):
     indices.sort(key = lambda ij: distances[ij//N][ij%N])
     return ((ij//N,ij%N) for ij in indices)
 
-def solve_tsp( distances, optim_steps=3, pairs_by_dist=pairs_by_dist, endpoints=None ):
+def solve_tsp( distances, optim_steps="auto", pairs_by_dist=pairs_by_dist, endpoints=None, local_search="2opt",
+               time_budget=None, return_info=False ):
     """Given a distance matrix, finds a solution for the TSP problem.
     Returns list of vertex indices. 
     Guarantees that the first index is lower than the last
 
     :arg: distances : left-triangular matrix of distances. array of arrays
-    :arg: optim_steps (int) number of additional optimization steps, allows to improve solution but costly.
+    :arg: optim_steps (int) number of additional optimization steps (rounds of the local search), allows to improve solution but costly.
+          None runs the local search until it finds no improving move.
+          "auto" (default) is 3 without a time_budget, and None with one, so that the search goes on until
+          it reaches a local optimum or the time is up
     :arg: pairs_by_dist (function) an implementtion of the pairs_by_dist function. for optimization purposes.
     :arg: endpoinds : None or pair (int,int)
+    :arg: local_search (str) : optimization procedure, one of local_searches:
+          "2opt" (two_opt), "oropt" (or_opt) or "or3opt" (or_3opt)
+    :arg: time_budget (float) : None or number of seconds given to the local search, after which the best path
+          found so far is returned. The greedy path is always built first and the budget only starts counting
+          once it is done, so the whole call takes greedy_elapsed + time_budget at most (plus the final move).
+          The time is checked during the nearest neighbor search and the local search.
+    :arg: return_info (bool) : if True, returns (path, info) where info is a dict with
+          "stop" : why the search stopped: "local optimum", "optim_steps" or "time_budget"
+          "cost" : length of the path (util.path_cost)
+          "moves" : number of improving moves of the local search
+          "elapsed" : time spent, in seconds
+          "greedy_elapsed" : part of elapsed spent building the greedy path, before the time_budget starts counting
     """
+    start_time = _clock()
+    greedy_elapsed = 0.0
+    if optim_steps == "auto":
+        optim_steps = 3 if time_budget is None else None
+
+    def finish(path, stop, moves=0):
+        if not return_info: return path
+        return path, { "stop": stop, "cost": float(path_cost(distances, path)), "moves": moves,
+                       "elapsed": _clock() - start_time, "greedy_elapsed": greedy_elapsed }
+
     N = len(distances)
-    if N == 0: return []
-    if N == 1: return [0]
+    if N == 0: return finish([], "local optimum")
+    if N == 1: return finish([0], "local optimum")
 
     _assert_triangular(distances)
 
@@ -175,10 +394,22 @@ def solve_tsp( distances, optim_steps=3, pairs_by_dist=pairs_by_dist, endpoints=
     #invoke main greedy algorithm
     join_segments(pairs_by_dist(N, distances))
 
+    #restore path from the connections map (graph)
+    path = restore_path( connections, endpoints=endpoints )
+    greedy_elapsed = _clock() - start_time
+
     #now call additional optiomization procedure.
-    for passn in range(optim_steps):
-        nopt, dtotal = optimize_solution( distances, connections, endpoints )
-        if nopt == 0:
-            break
-    #restore path from the connections map (graph) and return it
-    return restore_path( connections, endpoints=endpoints )
\ No newline at end of file
+    if optim_steps is not None and optim_steps <= 0:
+        return finish(path, "optim_steps")
+    #the time budget is for the local search only
+    deadline = None if time_budget is None else _clock() + time_budget
+    if time_budget is not None and time_budget <= 0:
+        return finish(path, "time_budget")
+    rows = square_matrix(distances)
+    if deadline is not None and _clock() >= deadline:
+        return finish(path, "time_budget")
+    near = nearest_neighbors(rows, deadline=deadline)
+    if near is None:
+        return finish(path, "time_budget")
+    moves, gain, stop = local_searches[local_search]( path, rows, max_rounds=optim_steps, near=near, deadline=deadline )
+    return finish(path, stop, moves)
\ No newline at end of file
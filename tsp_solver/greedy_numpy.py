@@ -8,23 +8,79 @@ else:
     #py2
     pass
 
-def pairs_by_dist_np(N, distances):
-    """optimized version of pairs_by_dist, using numpy"""
-    pairs = numpy.zeros( (N*(N-1)//2, ), dtype=('f4, i2, i2') )
-
-    idx = 0
-    for i in xrange(N):
-        row_size = i
-        dist_i = distances[i]
-        pairs[idx:(idx+row_size)] = [ (dist_i[j], i, j)
-                                      for j in xrange(i) ]
-        idx += row_size
-    pairs.sort(order=["f0"]) #sort by the first field
-    return pairs[["f1","f2"]]
-
-
-def solve_tsp( distances, optim_steps=3,pairs_by_dist = pairs_by_dist_np , endpoints=None):
+def lower_triangle(N, distances):
+    """Indices (i, j), i > j, of the left-triangular part of the distance matrix, in row order, and the distances.
+    Index arrays use the smallest unsigned type that holds N and are built directly in that type, row by row,
+    without int64 temporaries; distances are float64."""
+    index_type = numpy.min_scalar_type(max(N - 1, 0))
+    size = N*(N - 1)//2
+    nodes = numpy.arange(N, dtype=index_type)
+    i = numpy.repeat(nodes, numpy.arange(N)) #row r holds r pairs
+    j = numpy.empty(size, dtype=index_type)
+    dist = numpy.empty(size, dtype=numpy.float64)
+    start = 0
+    for row in xrange(1, N):
+        j[start:start + row] = nodes[:row]
+        dist[start:start + row] = distances[row][:row]
+        start += row
+    return i, j, dist
+
+def pairs_by_dist_np(N, distances, chunk_size=None, factors=None):
+    """optimized version of pairs_by_dist, using numpy
+    Pairs of equal distance come in row order, as with a stable sort.
+
+    :arg: chunk_size : None sorts all the pairs at once. Otherwise the pairs are sorted lazily, in chunks of
+          chunk_size, 2*chunk_size, 4*chunk_size... pairs. The distances that bound the chunks are found at once with
+          numpy.partition on a copy of the distances; a chunk (the pairs between its two bounds, ties included) is only
+          selected with a boolean mask and sorted when the previous one is used up. The greedy algorithm usually stops
+          long before the last pairs. Apart from the partition copy and the masks, only the current chunk is stored.
+    :arg: factors : None or array of N*(N-1)/2 factors the distances are multiplied by before sorting,
+          in the row order of lower_triangle"""
+    i, j, dist = lower_triangle(N, distances)
+    if factors is not None:
+        dist *= factors
+
+    def emit(order):
+        for start in xrange(0, len(order), 65536):
+            block = order[start:start + 65536]
+            for pair in zip(i[block].tolist(), j[block].tolist()):
+                yield pair
+
+    if chunk_size is None or chunk_size >= len(dist):
+        for pair in emit(numpy.argsort(dist, kind="stable")):
+            yield pair
+        return
+
+    #ranks of the last pair of every chunk but the last one
+    ranks = []
+    total = 0
+    while total + chunk_size < len(dist):
+        total += chunk_size
+        ranks.append(total - 1)
+        chunk_size *= 2
+    bounds = numpy.partition(dist, ranks)[ranks].tolist() + [None]
+
+    low = None
+    for high in bounds:
+        #pairs with low < distance <= high, in row order, so a stable sort keeps ties in row order
+        selected = numpy.ones(len(dist), dtype=bool) if low is None else dist > low
+        if high is not None:
+            selected &= dist <= high
+        chunk = numpy.flatnonzero(selected)
+        del selected
+        for pair in emit(chunk[numpy.argsort(dist[chunk], kind="stable")]):
+            yield pair
+        low = high
+
+def pairs_by_dist_lazy_np(N, distances):
+    """pairs_by_dist_np sorting the pairs in chunks, starting with 4*N pairs"""
+    return pairs_by_dist_np(N, distances, chunk_size=4*N)
+
+
+def solve_tsp( distances, optim_steps="auto",pairs_by_dist = pairs_by_dist_lazy_np , endpoints=None, local_search="2opt",
+               time_budget=None, return_info=False):
     """Given a distance matrix, finds a solution for the TSP problem.
     Returns list of vertex indices.
     Version that uses Numpy - consumes less memory and works faster."""
-    return base_solve_tsp( distances, optim_steps=optim_steps, pairs_by_dist=pairs_by_dist_np, endpoints=endpoints )
+    return base_solve_tsp( distances, optim_steps=optim_steps, pairs_by_dist=pairs_by_dist, endpoints=endpoints, local_search=local_search,
+                           time_budget=time_budget, return_info=return_info )
@@ -0,0 +1,106 @@
+import time
+import numpy
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from tsp_solver.greedy import solve_tsp as base_solve_tsp, square_matrix, nearest_neighbors, local_searches
+from tsp_solver.greedy_numpy import pairs_by_dist_np
+from tsp_solver.util import path_cost
+################################################################################
+# Multi-start version of the solver: several greedy solutions, built from
+# randomly perturbed distances and each improved by local search, are run on
+# a process pool and the shortest one is kept
+################################################################################
+
+def solve_tsp_multistart( distances, starts=8, workers=None, seed=0, perturbation=0.1, optim_steps=None,
+                          local_search="or3opt", endpoints=None, time_budget=None, return_info=False ):
+    """Given a distance matrix, finds a solution for the TSP problem from several starts.
+    Returns list of vertex indices of the shortest path found.
+
+    Start 0 is the plain greedy solution; start k > 0 builds the greedy solution on the distances
+    multiplied by random factors in [1, 1 + perturbation). Each start is then improved by the local
+    search on the exact distances. The distance matrix is shared with the worker processes through
+    shared memory and never copied by them: the factors are drawn only for the pairs of the left
+    triangle and applied to the sorted distances. The random factors of start k only depend on
+    seed and k, so the result is the same for any number of workers.
+
+    :arg: distances : left-triangular matrix of distances (array of arrays or numpy array)
+    :arg: starts (int) : number of starts
+    :arg: workers (int) : number of worker processes; None uses one per core, 1 runs in this process
+    :arg: seed (int) : seed of the random perturbations
+    :arg: perturbation (float) : relative amplitude of the perturbations
+    :arg: optim_steps, local_search, endpoints : see greedy.solve_tsp
+    :arg: time_budget (float) : None or number of seconds after which every start returns its best path.
+          Start 0 always runs; a start k > 0 that has not begun when the time is up is skipped
+    :arg: return_info (bool) : if True, returns (path, info) where info is a dict with
+          "cost" : length of the path, "start" : start that found it, "costs" : length found by every start
+          (None for the skipped ones),
+          "stop" : why the local search of that start stopped (see greedy.solve_tsp), "elapsed" : time spent
+    """
+    if starts < 1: raise ValueError("starts must be at least 1, got {starts}".format(**locals()))
+    start_time = time.time()
+    deadline = None if time_budget is None else start_time + time_budget
+    matrix = square_matrix(distances)
+    N = len(matrix)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, matrix.nbytes))
+    try:
+        shared = numpy.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shm.buf)
+        shared[:] = matrix
+        del matrix
+        args = [ (shm.name, N, seed, k, perturbation, optim_steps, local_search, endpoints, deadline)
+                 for k in range(starts) ]
+        if workers == 1:
+            results = [ _solve_start(*a) for a in args ]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = [ task.result() for task in [pool.submit(_solve_start, *a) for a in args] ]
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+    #shortest path, the lowest start first on ties
+    best = min((k for k in range(starts) if results[k] is not None), key=lambda k: (results[k][1], k))
+    path, cost, stop = results[best]
+    if not return_info: return path
+    return path, { "cost": cost, "start": best, "costs": [None if r is None else r[1] for r in results], "stop": stop,
+                   "elapsed": time.time() - start_time }
+
+def _solve_start( name, N, seed, k, perturbation, optim_steps, local_search, endpoints, deadline ):
+    """Process pool task: greedy solution of start k, improved by local search.
+    Returns path, its length and the reason of the stop of the local search,
+    or None if k > 0 and the deadline has passed before the start"""
+    if k > 0 and deadline is not None and time.time() >= deadline:
+        return None
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        matrix = numpy.ndarray((N, N), buffer=shm.buf)
+        if k == 0:
+            pairs_by_dist = pairs_by_dist_np
+        else:
+            #one factor for each pair of the left triangle, the only part read by the greedy algorithm
+            rng = numpy.random.default_rng([seed, k])
+            factors = 1 + perturbation*rng.random(N*(N - 1)//2, dtype=numpy.float32)
+            pairs_by_dist = lambda N, distances: pairs_by_dist_np(N, distances, factors=factors)
+        path = base_solve_tsp(matrix, optim_steps=0, pairs_by_dist=pairs_by_dist, endpoints=endpoints)
+        path = [int(i) for i in path]
+        factors = None
+
+        #the local search runs on the shared matrix, which is already square and symmetric
+        stop = "optim_steps"
+        if optim_steps is None or optim_steps > 0:
+            #the deadline is a wall clock time, shared by all processes
+            local_deadline = None
+            if deadline is not None:
+                local_deadline = time.perf_counter() + (deadline - time.time())
+            near = nearest_neighbors(matrix, deadline=local_deadline)
+            if near is None:
+                stop = "time_budget"
+            else:
+                moves, gain, stop = local_searches[local_search](path, matrix, max_rounds=optim_steps, near=near,
+                                                                 deadline=local_deadline)
+        cost = float(path_cost(matrix, path))
+        del matrix
+    finally:
+        shm.close()
+    return path, cost, stop